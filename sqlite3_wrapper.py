@@ -11,7 +11,8 @@
 ##  Description: A high level wrapper class for Sqlite3 databases. Add,     ##
 ##                 remove and clear tables quickly. Get results that match  ##
 ##                 a dictionary of values. Insert or update (upsert) in one ##
-##                 function call (uses two SQL executions).                 ##
+##                 function call (uses one SQL execution when selecting by  ##
+##                 a PRIMARY KEY or UNIQUE key, otherwise two).             ##
 ##                                                                          ##
 ##    Changelog: B=Bug, A=Add, R=Remove, C=Change                           ##
 ##    2.0.5 - C: Remove duplicates requested in a "get_list"                ##
@@ -21,6 +22,78 @@
 ##            A: Decent documentation (in the form of Docstrings & comments)##
 ##            A: Alias functions upsert=put, insert=post                    ##
 ##    2.3.0 - A: create|delete|reset_all_tables functions                   ##
+##    2.4.0 - A: put_many, post_many, delete_many bulk functions            ##
+##            B: get_all & delete with an empty selection dictionary        ##
+##    2.5.0 - A: Native single statement upsert when selecting by a unique  ##
+##               key (SQLite 3.24+ for put_many, 3.35+ for put)             ##
+##            A: Table level PRIMARY KEY (a, b) & UNIQUE (a, b) support     ##
+##    2.6.0 - A: Query cache, the SQL for each query shape is only built &  ##
+##               checked once. See query_cache_size & query_cache_info      ##
+##            C: put no longer adds the select_dict values to put_dict      ##
+##            B: put with a None in the selection dictionary                ##
+##            B: Invalid sorting type error message                         ##
+##    2.7.0 - A: The database structure is indexed once, so checking keys   ##
+##               no longer scans the table's columns                        ##
+##    2.8.0 - A: iter_all, a generator that streams results in batches      ##
+##               as dictionaries, tuples or namedtuples                     ##
+##    2.9.0 - A: limit & offset for get_all & iter_all                      ##
+##            A: get_page, keyset pagination with a continuation token      ##
+##            C: get only asks the database for one row (LIMIT 1)           ##
+##    2.10.0 - A: Indexes (including unique & partial) in the database      ##
+##               structure, created by create_table                         ##
+##            A: explain, shows the query plan & flags full table scans     ##
+##    2.11.0 - A: Connection pool (pool_size) with WAL mode, for sharing the##
+##               database between threads                                   ##
+##            A: busy_timeout                                               ##
+##            B: table_exists always returned True                          ##
+##    2.12.0 - A: sqlite3_wrapper_async.AsyncDatabase, an asyncio front-end ##
+##    2.13.0 - A: transaction() context manager, nested with savepoints.    ##
+##            A: batch_writes & batch_interval, automatic commits.          ##
+##            A: synchronous & journal_mode Database arguments.             ##
+##            C: commit() does nothing inside a transaction().              ##
+##    2.14.0 - A: cache_table(), a per table read-through result cache.     ##
+##               LRU, TTL & memory limit, see result_cache_info().          ##
+##    2.15.0 - A: get_columns(), results as typed arrays per column.        ##
+##               NumPy arrays when NumPy is installed.                      ##
+##    2.16.0 - A: IN, NOTIN, BETWEEN, LIKE & GLOB comparisons.              ##
+##            A: OR key, matches any of a list of selection dicts.          ##
+##               Long IN lists are sent as one JSON parameter.              ##
+##    2.17.0 - A: count() & aggregate() with group_by, run in SQLite.       ##
+##    2.18.0 - A: import_rows() & export_rows() for CSV & JSON lines.       ##
+##               Streamed in chunks, indexes rebuilt after imports.         ##
+##    2.19.0 - A: hook Database argument, called after every statement.     ##
+##            A: QueryStats hook, latency histograms & slow query log.      ##
+##            A: print_query hook, replaces _DEBUG (which still works).     ##
+##    2.20.0 - A: profile Database argument, READ_HEAVY, BULK_LOAD &        ##
+##               DURABLE tuning (mmap, cache, temp store, page size).       ##
+##            A: settings(), the PRAGMA settings in effect.                 ##
+##            C: close() runs PRAGMA optimize.                              ##
+##    2.21.0 - A: ROW row type for get_all, get & iter_all. A compact       ##
+##               tuple per row, read by column name, key or index.          ##
+##    2.21.1 - B: iter_all only checks out a reader once it is started,     ##
+##               and reads inside an iter_all loop share its reader.        ##
+##            B: Long IN lists are split into OR'd groups of 256 values     ##
+##               instead of JSON, so they follow the column affinity.       ##
+##            R: Python 2.7 & 3.5 support, needs Python 3.6+ (savepoints).  ##
+##            B: put() with an empty selection dict creates a new record    ##
+##               instead of overwriting an existing one.                    ##
+##            B: put_many() flushes before a lookup that could match a      ##
+##               held back insert after type affinity or NOCASE/RTRIM.      ##
+##            B: export_rows() opens the file before it reads any rows.     ##
+##            B: _DEBUG is checked for each statement, not only when the    ##
+##               Database is opened.                                        ##
+##    2.21.2 - B: put() only uses a single upsert statement when it updates ##
+##               rows the same way: not with NOT NULL columns (no DEFAULT)  ##
+##               left out of the put, CHECK constraints or AUTOINCREMENT.   ##
+##            B: Invalid IN & BETWEEN values raise SyntaxError even when    ##
+##               a valid query of the same shape is in the query cache.     ##
+##            B: delete() & delete_many() raise SyntaxError for an empty    ##
+##               selection dict instead of deleting every record.           ##
+##            B: batch_interval commits from a timer, not on the next write.##
+##            B: Long IN lists use JSON again, compared with the column's   ##
+##               affinity. Lists that aren't JSON (e.g. dates) are split    ##
+##               into groups of 256, limited to SQLite's 999 (32766 since   ##
+##               3.32) parameters per statement.                            ##
 ##                                                                          ##
 ##        Usage: (See test() for examples. see Docstrings for more detail.) ##
 ##             > import sqlite3_wrapper as sql                              ##
@@ -31,17 +104,66 @@
 ##             > db.post - same as put, but forces new record               ##
 ##             > db.insert - alias for post                                 ##
 ##             > db.get_all(table, selection_dict, optional_list_to_get)    ##
+##                  selection_dict is {key: value or (value, COMPARISON)},  ##
+##                  e.g. {"a": ([1, 2], IN), OR: [{"b": 1}, {"c": 2}]}      ##
 ##                  returns a dictionary containing every (requested) value ##
 ##             > db.get - same as get_all, but returns the first match only ##
+##             > db.get_all(table, selection_dict, row_type=ROW)            ##
+##                  returns rows read by row.key, row["key"] or row[0]      ##
+##             > db.iter_all - same as get_all, but yields the matches      ##
+##             > db.count(table, selection_dict)                            ##
+##             > db.aggregate(table, selection_dict, {alias: (SUM, key)})   ##
+##                  returns {alias: sum}, optionally group_by keys          ##
+##             > db.get_page(table, selection_dict, ..., page_size, token)  ##
+##                  returns a page of matches & the token for the next page ##
 ##             > db.delete(table, selection_dict)                           ##
+##             > db.put|post|delete_many(table, list_of_rows)               ##
+##                  bulk versions, one transaction, returns the row count   ##
 ##             > db.create|delete|reset_table(table_name)                   ##
+##             > db.import_rows(table, "rows.csv", CSV)                     ##
+##             > db.export_rows(table, selection_dict, "rows.jsonl", JSONL) ##
+##                  streams rows in chunks, returns the row count           ##
+##             > db.explain(table, selection_dict, sort_by)                 ##
+##                  returns the query plan & any tables without an index    ##
 ##             > db.commit|close(table_name)                                ##
+##             > sql.Database("name.db", database_structure, pool_size=4)   ##
+##                  thread safe, parallel readers & one writer (WAL mode)   ##
+##             > with db.transaction(): - commits at the end of the block,  ##
+##                  rolls back on an exception, can be nested               ##
+##             > sql.Database(..., batch_writes=1000, synchronous="NORMAL") ##
+##                  commits automatically every 1000 writes                 ##
+##             > db.cache_table(table, maxsize, ttl, max_bytes)             ##
+##                  caches get_all results until the table is written to    ##
+##             > db.get_columns(table, selection_dict, optional_list)       ##
+##                  returns a dictionary of arrays, one per column          ##
+##             > sql.Database(..., profile=sql.READ_HEAVY)                  ##
+##                  mmap & a larger cache, see PROFILES & db.settings()     ##
+##             > sql.Database(..., hook=sql.QueryStats(slow_query_ms=50))   ##
+##                  latency histogram per query & slow query log, or use    ##
+##                  hook=sql.print_query to print every statement           ##
 ##                                                                          ##
 ##############################################################################
 import sqlite3
+import array
+import csv
+import json
+import queue
 import re
-
-__version__ = "2.3.0"
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from itertools import chain, groupby, islice
+from operator import itemgetter
+try:
+    import numpy as _numpy
+except ImportError:
+    _numpy = None
+
+__version__ = "2.21.2"
+# print every statement (the same as Database(..., hook=print_query)) for databases without a hook
 _DEBUG = False
 
 EQ                 = "="
@@ -57,7 +179,15 @@ GREATERTHAN        = GT
 GREATERTHANOREQUAL = GTEQ
 LESSTHAN           = LT
 LESSTHANOREQUAL    = LTEQ
-VALID_COMPARISONS  = [EQ, NEQ, GT, GTEQ, LT, LTEQ]
+IN                 = "IN"
+NOTIN              = "NOT IN"
+BETWEEN            = "BETWEEN"
+LIKE               = "LIKE"
+GLOB               = "GLOB"
+VALID_COMPARISONS  = [EQ, NEQ, GT, GTEQ, LT, LTEQ, IN, NOTIN, BETWEEN, LIKE, GLOB]
+
+# the key for a list of selection dictionaries, any of which can match
+OR                 = "OR"
 
 ASC                = "ASC"
 DESC               = "DESC"
@@ -67,39 +197,779 @@ DESCENDING         = DESC
 DOWN               = DESC
 VALID_SORTING      = [ASC, DESC]
 
+COUNT              = "COUNT"
+SUM                = "SUM"
+AVG                = "AVG"
+MIN                = "MIN"
+MAX                = "MAX"
+AVERAGE            = AVG
+MINIMUM            = MIN
+MAXIMUM            = MAX
+VALID_AGGREGATES   = [COUNT, SUM, AVG, MIN, MAX]
+
+CSV                = "csv"
+JSONL              = "jsonl"
+VALID_FILE_FORMATS = [CSV, JSONL]
+
+VALID_SYNCHRONOUS  = ["OFF", "NORMAL", "FULL", "EXTRA"]
+VALID_JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+VALID_TEMP_STORES  = ["DEFAULT", "FILE", "MEMORY"]
+
+READ_HEAVY         = "read_heavy"
+BULK_LOAD          = "bulk_load"
+DURABLE            = "durable"
+# the PRAGMA settings of each tuning profile, see Database
+PROFILES = {
+    # read pages straight from the OS page cache (rather than copying them with read()) and cache more of them
+    # mmap_size is limited to the largest size SQLite was compiled with (usually 2 GB)
+    READ_HEAVY: {"mmap_size": 1 << 40, "cache_size": -64 * 1024, "temp_store": "MEMORY"},
+    # larger pages (only for a new database) and cache, and don't wait for the disk (a crash can corrupt the database)
+    BULK_LOAD:  {"page_size": 16384, "cache_size": -256 * 1024, "temp_store": "MEMORY", "synchronous": "OFF"},
+    # wait for the disk (and the journal's directory) after every commit, so commits survive a power loss
+    DURABLE:    {"synchronous": "EXTRA"},
+}
+VALID_PROFILES     = [READ_HEAVY, BULK_LOAD, DURABLE]
+
+# the settings a profile can have, in the order they must be applied (the page size can't change in WAL mode)
+_SETTINGS          = ["page_size", "journal_mode", "synchronous", "cache_size", "mmap_size", "temp_store"]
+# the settings that belong to each connection, rather than the database
+_CONNECTION_SETTINGS = ["cache_size", "mmap_size", "temp_store"]
+
+DICT               = "dict"
+TUPLE              = "tuple"
+NAMEDTUPLE         = "namedtuple"
+ROW                = "row"
+VALID_ROW_TYPES    = [DICT, TUPLE, NAMEDTUPLE, ROW]
+
+# native upserts need ON CONFLICT (SQLite 3.24) and put needs RETURNING (SQLite 3.35) to get the rowid
+_SQLITE_HAS_UPSERT    = sqlite3.sqlite_version_info >= (3, 24, 0)
+_SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# the bulk functions send at most this many rows to each executemany call
+_BULK_CHUNK_SIZE   = 10000
+
+# longer IN lists are sent as a single JSON array parameter (if SQLite has the JSON functions and the values
+# can all be sent as JSON), otherwise they are split into OR'd IN lists of this many values
+_IN_LIST_MAX       = 256
+try:
+    _connection = sqlite3.connect(":memory:")
+    _connection.execute("SELECT value FROM json_each('[]')").fetchall()
+    _SQLITE_HAS_JSON = True
+except sqlite3.OperationalError:
+    _SQLITE_HAS_JSON = False
+finally:
+    _connection.close()
+
 class InvalidName(Exception): pass
 class KeyNotInTable(Exception): pass
 class TableNotInDatabase(Exception): pass
 class InvalidComparisonType(Exception): pass
 class InvalidSortingType(Exception): pass
+class InvalidRowType(Exception): pass
+class InvalidAggregateType(Exception): pass
+class InvalidFileFormat(Exception): pass
+
+# compiled SQL stored in the query cache
+_SelectQuery = namedtuple("_SelectQuery", "sql get_list")
+_PutQuery    = namedtuple("_PutQuery", "upsert upsert_many lookup update insert extra")
+
+# a statement reported to the instrumentation hook, see Database
+# params is None (and param_count the number of parameter sets) for executemany, rows is None if it isn't known,
+# explain() returns the EXPLAIN QUERY PLAN steps (call it from the hook, it uses the statement's connection)
+QueryEvent   = namedtuple("QueryEvent", "sql params param_count rows seconds explain")
+
+
+def _freeze(value):
+    """Convert lists, sets & dictionaries (and those inside tuples) so that value can be used in a cache key."""
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+def _loose_key(value):
+    """Return a key that is the same for any two values SQLite could compare as equal.
+
+    Covers type affinity (e.g. 1, 1.0 & " 1" in an INTEGER column, or 1 & "1" in a TEXT column) and the NOCASE
+    & RTRIM collations. Values that SQLite sees as different can share a key, but never the other way round.
+    RETURN >>> >>> The key, or None for a type it doesn't know (which could be equal to anything)
+    """
+    if value is None:
+        return ("null",)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return ("blob", bytes(value))
+    if isinstance(value, (int, float)):
+        number = float(value)
+    elif isinstance(value, str):
+        text = value.strip()
+        # SQLite only converts text that starts like a number (not "inf" or "nan")
+        if not text[:1] or not text[0] in "0123456789+-.":
+            return ("text", text.lower())
+        try:
+            number = float(text)
+        except ValueError:
+            return ("text", text.lower())
+    else:
+        return None
+    # NaN isn't equal to itself
+    return ("number", number) if number == number else None
+
+
+def _json_safe(value):
+    """Return whether value is the same after a round trip through JSON and SQLite's json_each."""
+    if value is None or isinstance(value, (bool, str)):
+        return True
+    if isinstance(value, int):
+        return -2 ** 63 <= value < 2 ** 63
+    # NaN & infinity aren't JSON
+    return isinstance(value, float) and value - value == 0
+
+
+def _in_list_size(values):
+    """Return the number of parameters used for an IN list, or None if it is sent as one JSON array parameter.
+
+    The length is rounded up to a power of two, or a multiple of _IN_LIST_MAX for longer lists (the last value
+    is repeated), so that lists of similar lengths share the same SQL in the query cache.
+    Every parameter counts towards SQLite's limit on the number in a statement (999, or 32766 since 3.32).
+    """
+    if len(values) > _IN_LIST_MAX:
+        if _SQLITE_HAS_JSON and all(_json_safe(x) for x in values):
+            return None
+        return -(-len(values) // _IN_LIST_MAX) * _IN_LIST_MAX
+    size = 1 if values else 0
+    while size < len(values):
+        size *= 2
+    return size
+
+
+# everything in a column's declared type before its constraints, e.g. "UNSIGNED BIG INT" in "UNSIGNED BIG INT NOT NULL"
+_TYPE_NAME_END = re.compile(r"\(|\b(?:CONSTRAINT|PRIMARY|NOT|NULL|UNIQUE|CHECK|DEFAULT|COLLATE|REFERENCES|GENERATED|AS)\b", re.IGNORECASE)
+
+
+def _column_affinity(data_type):
+    """Return the type affinity of a declared column type, following SQLite's rules.
+
+    RETURN >>> >>> "INTEGER", "TEXT", "BLOB", "REAL" or "NUMERIC"
+    """
+    type_name = _TYPE_NAME_END.split(data_type, 1)[0].upper()
+    if "INT" in type_name:
+        return "INTEGER"
+    if "CHAR" in type_name or "CLOB" in type_name or "TEXT" in type_name:
+        return "TEXT"
+    if "BLOB" in type_name or not type_name.strip():
+        return "BLOB"
+    if "REAL" in type_name or "FLOA" in type_name or "DOUB" in type_name:
+        return "REAL"
+    return "NUMERIC"
+
+
+def _column_typecode(data_type):
+    """Return the array typecode for a declared column type.
+
+    RETURN >>> >>> "q" for INTEGER affinity, "d" for REAL affinity, or None for TEXT, BLOB & NUMERIC affinity
+    """
+    return {"INTEGER": "q", "REAL": "d"}.get(_column_affinity(data_type))
+
+
+def _extend_column(column, values):
+    """Add values to a column that can't hold them (e.g. a NULL), returning the column to use from now on.
+
+    NULLs in a REAL column become NaN, otherwise the column is converted to a list.
+    """
+    if column.typecode == "d":
+        try:
+            column.fromlist([float("nan") if value is None else value for value in values])
+            return column
+        except (TypeError, OverflowError):
+            pass
+    column = column.tolist()
+    column.extend(values)
+    return column
+
+
+@contextmanager
+def _open_file(target, mode):
+    """Yield target if it is a file object (or iterator), otherwise open it as a filename and close it afterwards."""
+    if not isinstance(target, str):
+        yield target
+        return
+    # the csv module needs newline="" to handle newlines inside quoted values
+    with open(target, mode, newline="", encoding="utf-8") as f:
+        yield f
+
+
+def _json_values(objects, keys):
+    """Yield a tuple of the values of keys from each JSON object, checking that every object has exactly those keys."""
+    getter = itemgetter(*keys) if len(keys) > 1 else lambda obj: (obj[keys[0]],)
+    for line, obj in enumerate(objects, 1):
+        try:
+            if len(obj) != len(keys):
+                raise KeyError
+            yield getter(obj)
+        except KeyError:
+            raise SyntaxError("JSON object {} doesn't have the same keys as the first: {}".format(line, ", ".join(keys)))
+
+
+def _iter_cursor(cursor, batch_size, make_row, release=None):
+    """Yield make_row(row) (or row if make_row is None) for every row in the cursor, fetching batch_size rows at a time.
+
+    Closes the cursor and calls release() (if given) when finished.
+    """
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if make_row is not None:
+                rows = map(make_row, rows)
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+        if release:
+            release()
+
+
+class _Row(tuple):
+    """The base of the ROW row type: a tuple of a row's values that can also be read by column name.
+
+    e.g. row.author, row["author"], row[0], row.get("author"), dict(row) or name, author = row
+    Each (table, columns) has a subclass made by _make_row_class, which holds the shared column index map.
+    Iterating gives the values (like a tuple), use keys() or items() for the column names.
+    """
+    __slots__ = ()
+    _columns = ()
+    _index = {}
+
+    def __new__(cls, cursor, row):
+        # the class is the cursor's row_factory, so rows are made as they are fetched
+        return tuple.__new__(cls, row)
+
+    def __getnewargs__(self):
+        # for copy.copy
+        return (None, tuple(self))
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        """Return the value of the column, or default if there is no such column."""
+        i = self._index.get(key)
+        return default if i is None else tuple.__getitem__(self, i)
+
+    def keys(self):
+        """Return the column names."""
+        return self._columns
+
+    def values(self):
+        """Return the values, in column order."""
+        return tuple(self)
+
+    def items(self):
+        """Return a list of (column, value) tuples."""
+        return list(zip(self._columns, self))
+
+    def _asdict(self):
+        """Return a dictionary of {column: value}."""
+        return dict(zip(self._columns, self))
+
+    def __repr__(self):
+        return "{}({})".format(type(self).__name__, ", ".join("{}={!r}".format(k, v) for k, v in zip(self._columns, self)))
+
+
+def _make_row_class(table_name, columns):
+    """Return a _Row subclass for the columns, with a read only attribute for each one.
+
+    Columns that would hide a _Row function (e.g. "keys" or "count") can only be read by name or index.
+    """
+    namespace = {"__slots__": (), "_columns": tuple(columns), "_index": dict((k, i) for i, k in enumerate(columns))}
+    for i, k in enumerate(columns):
+        if not hasattr(_Row, k):
+            namespace[k] = property(itemgetter(i), doc="The {} column".format(k))
+    return type(table_name + "_row", (_Row,), namespace)
+
+
+class _TableSchema(object):
+    """The columns and constraints of a table in the database structure, indexed for fast lookups."""
+    __slots__ = ("name", "columns", "types", "typecodes", "get_list", "definition", "unique_keys", "foreign_keys", "indexes",
+                 "required", "checks", "autoincrement")
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = {}       # {lowercase_key: key}
+        self.types = {}         # {lowercase_key: key_type}
+        self.typecodes = {}     # {lowercase_key: array_typecode or None}, see _column_typecode
+        self.get_list = ()      # every column, in order (the default get_list)
+        self.definition = ""    # the columns & table constraints for CREATE TABLE
+        self.unique_keys = {}   # {frozenset(lowercase_keys): keys} for each PRIMARY KEY or UNIQUE constraint
+        self.foreign_keys = []  # [(key, referenced_table, referenced_key), ...]
+        self.indexes = []       # [(index_name, create_index_sql), ...]
+        self.required = set()   # {lowercase_key, ...} NOT NULL columns without a DEFAULT
+        self.checks = False     # whether the table has any CHECK constraints
+        self.autoincrement = False
+
+
+class _LRUCache(object):
+    """A dictionary that holds up to maxsize items, discarding the least recently used item first."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # the cache is shared by every thread using a pooled database
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the value for key, or None if it isn't in the cache."""
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Add the value for key, discarding the least recently used item if the cache is full."""
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Remove every item from the cache."""
+        with self._lock:
+            self._data.clear()
+
+    def info(self):
+        """Return a dictionary of the cache statistics."""
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize}
+
+
+class _ResultCache(object):
+    """A cache of one table's get_all results, discarding the least recently used results first.
+
+    Results expire after ttl milliseconds, and are discarded when there are more than maxsize of them or
+    they take up more than max_bytes (an estimate of the memory used by the rows).
+    """
+    def __init__(self, maxsize, ttl, max_bytes):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.bytes = 0
+        # increases every time the cache is cleared, so results read before a write aren't stored after it
+        self.generation = 0
+        self._data = OrderedDict()  # key: (expires, nbytes, rows)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _sizeof(rows):
+        """Return an estimate of the memory used by a list of rows (the column names are shared)."""
+        size = sys.getsizeof(rows)
+        for row in rows:
+            values = row.values() if isinstance(row, dict) else row
+            size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in values)
+        return size
+
+    def get(self, key):
+        """Return the rows for key, or None if they aren't in the cache (or have expired)."""
+        with self._lock:
+            try:
+                expires, nbytes, rows = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= time.time():
+                del self._data[key]
+                self.bytes -= nbytes
+                self.evictions += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return rows
+
+    def set(self, key, rows, generation):
+        """Add the rows for key, unless the cache has been cleared since generation was read."""
+        nbytes = self._sizeof(rows)
+        if self.maxsize <= 0 or nbytes > self.max_bytes:
+            return
+        expires = time.time() + self.ttl / 1000.0 if self.ttl is not None else None
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._data:
+                self.bytes -= self._data.pop(key)[1]
+            self._data[key] = (expires, nbytes, rows)
+            self.bytes += nbytes
+            while len(self._data) > self.maxsize or self.bytes > self.max_bytes:
+                self.bytes -= self._data.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        """Remove every result from the cache."""
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+            self.generation += 1
+            self.invalidations += 1
+
+    def info(self):
+        """Return a dictionary of the cache statistics."""
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "invalidations": self.invalidations,
+                "size": len(self._data), "maxsize": self.maxsize, "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+def print_query(event):
+    """An instrumentation hook that prints every statement, with its parameters, rows and time."""
+    params = event.params if event.params is not None else "({} parameter sets)".format(event.param_count)
+    rows = "" if event.rows is None else "{} rows, ".format(event.rows)
+    print("@SQL " + event.sql, params, "({}{:.3f} ms)".format(rows, event.seconds * 1000))
+
+
+class QueryStats(object):
+    """An instrumentation hook that keeps a latency histogram for each SQL statement, and a log of slow statements.
+
+    Statements are parameterized, so each one is a query shape (e.g. every get_all by "author" and "pages").
+    e.g. stats = QueryStats(slow_query_ms=50, explain_slow_queries=True)
+         db = Database("name.db", database_structure, hook=stats)
+    """
+    # the upper bound of each histogram bucket, in milliseconds
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float("inf"))
+
+    def __init__(self, slow_query_ms=100, explain_slow_queries=False, slow_log_size=100):
+        """slow_query_ms        -- Log statements that take at least this many milliseconds (None to log nothing).
+        explain_slow_queries -- Add the EXPLAIN QUERY PLAN steps to each slow statement in the log.
+        slow_log_size        -- The number of slow statements to keep, the oldest are discarded first.
+        """
+        self.slow_query_ms = slow_query_ms
+        self.explain_slow_queries = explain_slow_queries
+        self._shapes = {}  # {sql: [count, total_ms, max_ms, [count for each bucket]]}
+        self._slow = deque(maxlen=slow_log_size)
+        # a pooled database reports from every thread
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        ms = event.seconds * 1000
+        bucket = bisect_left(self.BUCKETS, ms)
+        with self._lock:
+            shape = self._shapes.get(event.sql)
+            if shape is None:
+                shape = self._shapes[event.sql] = [0, 0.0, 0.0, [0] * len(self.BUCKETS)]
+            shape[0] += 1
+            shape[1] += ms
+            shape[2] = max(shape[2], ms)
+            shape[3][bucket] += 1
+
+        if self.slow_query_ms is not None and ms >= self.slow_query_ms:
+            plan = event.explain() if self.explain_slow_queries and event.explain else None
+            entry = {"sql": event.sql, "params": event.params, "rows": event.rows, "ms": ms, "plan": plan, "time": time.time()}
+            with self._lock:
+                self._slow.append(entry)
+
+    def histograms(self):
+        """Return the statistics for each statement.
+
+        RETURN >>> >>> A dictionary of {sql: {"count", "total_ms", "mean_ms", "max_ms", "buckets"}}, where buckets is a
+                       list of (upper_bound_ms, count) for each non-empty bucket
+        """
+        with self._lock:
+            return {sql: {"count": count, "total_ms": total, "mean_ms": total / count, "max_ms": most,
+                          "buckets": [(bound, n) for bound, n in zip(self.BUCKETS, buckets) if n]}
+                    for sql, (count, total, most, buckets) in self._shapes.items()}
 
+    def slow_queries(self):
+        """Return the slow statement log, oldest first.
 
-class Database:
-    def __init__(self, fname, database_structure):
+        RETURN >>> >>> A list of dictionaries of "sql", "params", "rows", "ms", "plan" (or None) and "time"
+        """
+        with self._lock:
+            return list(self._slow)
+
+    def reset(self):
+        """Discard all the statistics and the slow statement log."""
+        with self._lock:
+            self._shapes.clear()
+            self._slow.clear()
+
+
+class Database(object):
+    def __init__(self, fname, database_structure, query_cache_size=256, pool_size=0, busy_timeout=5000,
+                 synchronous=None, journal_mode=None, batch_writes=None, batch_interval=None, hook=None, profile=None):
         """Open database from filename, initialise database structure.
 
         database structure should be of the format:
         {table_name: [(key_name, key_type), (key_name, key_type), ... ], ... }
         e.g. {"books": [("name", "TEXT PRIMARY KEY"), ("pages", "INTEGER")]}
+        Table constraints are also supported:
+        e.g. ("FOREIGN KEY (author)", "REFERENCES authors(name)"), ("UNIQUE (author, name)", "")
+        As are indexes, which are created with the table:
+        e.g. ("INDEX books_by_author", "(author, pages DESC)"), ("UNIQUE INDEX books_isbn", "(isbn)"),
+             ("INDEX books_long", "(pages) WHERE pages > 1000")
+
+        query_cache_size -- The number of query shapes to keep the compiled SQL for (0 to disable).
+        pool_size        -- The number of reader connections, so the database can be shared between threads.
+                            0 (the default) uses a single connection that can only be used by one thread.
+                            A pool puts the database in WAL mode. Reads (get_all, get, get_page, iter_all,
+                            table_exists, explain) run in parallel on the readers and only see committed
+                            changes. Writes are serialised on a single writer connection.
+        busy_timeout     -- How long to wait for another connection's lock before failing, in milliseconds.
+        synchronous      -- PRAGMA synchronous: OFF, NORMAL, FULL or EXTRA. Defaults to SQLite's default (FULL).
+        journal_mode     -- PRAGMA journal_mode: DELETE, TRUNCATE, PERSIST, MEMORY, WAL or OFF. Defaults to
+                            SQLite's default (DELETE), or WAL with a connection pool.
+        batch_writes     -- Commit automatically after this many writes (rows for the bulk functions).
+        batch_interval   -- Commit automatically when the oldest uncommitted write is this many milliseconds old.
+                            The commit is made by a timer thread (holding the write lock), so it happens even if
+                            no more writes are made. Writes in a transaction() are committed when it ends instead.
+        hook             -- A function called with a QueryEvent after every statement, e.g. print_query or a
+                            QueryStats. It can be changed (or set to None) at any time with db.hook.
+        profile          -- A tuning profile: READ_HEAVY, BULK_LOAD or DURABLE (see PROFILES), or a dictionary of
+                            page_size, journal_mode, synchronous, cache_size, mmap_size and temp_store PRAGMA
+                            settings. synchronous and journal_mode override the profile. See settings().
         """
-        self.conn = sqlite3.connect(fname, detect_types=sqlite3.PARSE_DECLTYPES)
+        if pool_size and fname in ("", ":memory:"):
+            raise ValueError("A connection pool needs a database file, every connection to an in-memory database is a new database.")
+        settings = self._process_profile(profile)
+        if synchronous is not None:
+            settings["synchronous"] = synchronous
+        if journal_mode is not None:
+            settings["journal_mode"] = journal_mode
+        self._assert_valid_settings(settings)
+        if pool_size:
+            if settings.get("journal_mode", "WAL").upper() != "WAL":
+                raise ValueError("A connection pool needs journal_mode WAL.")
+            settings["journal_mode"] = "WAL"
+
+        # batch_interval commits from a timer thread
+        self.conn = self._connect(fname, busy_timeout, check_same_thread=not pool_size and batch_interval is None)
         self.c = self.conn.cursor()
+        self._write_lock = threading.RLock()
+        self._apply_settings(self.conn, settings, _SETTINGS)
+
+        # result caches for the tables that have called cache_table, and the tables written to since the last commit
+        self._result_caches = {}
+        self._dirty_tables = set()
+
+        # instrumentation, see _execute
+        self.hook = hook
+
+        # automatic commits, see _wrote
+        self.batch_writes = batch_writes
+        self.batch_interval = batch_interval
+        self._uncommitted_writes = 0
+        self._first_uncommitted_write = None
+        self._commit_timer = None
+
+        # reader connections are checked out for each read, see _checkout_reader
+        self._readers = None
+        self._checkouts = {}
+        self._checkouts_lock = threading.Lock()
+        if pool_size:
+            self._readers = queue.Queue()
+            for _ in range(pool_size):
+                reader = self._connect(fname, busy_timeout, check_same_thread=False)
+                reader.execute("PRAGMA query_only=ON")
+                self._apply_settings(reader, settings, _CONNECTION_SETTINGS)
+                self._readers.put(reader)
+
         self.safeNamePattern = re.compile(r"[a-z_]\w*$", re.IGNORECASE)
+        self._savepoint_depth = 0
+        self._query_cache = _LRUCache(query_cache_size)
+        self._namedtuples = {}
+        self._row_classes = {}
         self.tables = database_structure
 
-        foreignKeyPattern = re.compile(r"FOREIGN KEY \(([a-z_]\w*)\)", re.IGNORECASE)
-
-        # check that all names are valid
-        for table_name, table in self.tables.items():
+    @property
+    def hook(self):
+        """The instrumentation hook, or print_query if there isn't one and _DEBUG is set. See __init__."""
+        if self._hook is None and _DEBUG:
+            return print_query
+        return self._hook
+
+    @hook.setter
+    def hook(self, hook):
+        self._hook = hook
+
+    @staticmethod
+    def _connect(fname, busy_timeout, check_same_thread):
+        """Open a connection to the database file."""
+        return sqlite3.connect(fname, timeout=busy_timeout / 1000.0, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=check_same_thread)
+
+    @staticmethod
+    def _process_profile(profile):
+        """Return a copy of the settings of a tuning profile (a name or a dictionary of settings)."""
+        if profile is None:
+            return {}
+        if isinstance(profile, dict):
+            return dict(profile)
+        if not profile in PROFILES:
+            raise ValueError("profile must be a dictionary of settings or one of: " + ", ".join(VALID_PROFILES))
+        return dict(PROFILES[profile])
+
+    @staticmethod
+    def _assert_valid_settings(settings):
+        """Check that every setting is known and has a valid value."""
+        choices = {"journal_mode": VALID_JOURNAL_MODES, "synchronous": VALID_SYNCHRONOUS, "temp_store": VALID_TEMP_STORES}
+        for name, value in settings.items():
+            if not name in _SETTINGS:
+                raise ValueError("Unknown setting '{}', settings are: {}".format(name, ", ".join(_SETTINGS)))
+            if name in choices:
+                if not str(value).upper() in choices[name]:
+                    raise ValueError("{} must be one of: {}".format(name, ", ".join(choices[name])))
+            elif not isinstance(value, int):
+                raise ValueError("{} must be an integer".format(name))
+
+    @staticmethod
+    def _apply_settings(conn, settings, names):
+        """Set the PRAGMAs in names (in that order) that are in settings, on the connection."""
+        for name in names:
+            if name in settings:
+                # fetch the result so the statement doesn't keep holding its lock
+                conn.execute("PRAGMA {}={}".format(name, str(settings[name]).upper())).fetchall()
+
+    def settings(self):
+        """Return the settings the database is actually using (see profile), which can differ from the ones asked for.
+
+        e.g. mmap_size is limited by SQLite, and page_size can't change once a database has tables.
+        RETURN >>> >>> A dictionary of page_size, journal_mode, synchronous, cache_size, mmap_size and temp_store
+        """
+        with self._write_lock:
+            settings = {}
+            for name in _SETTINGS:
+                rows = self._fetch_all(self.c, "PRAGMA " + name)
+                settings[name] = rows[0][0] if rows else None
+        # these are returned as numbers
+        settings["synchronous"] = VALID_SYNCHRONOUS[settings["synchronous"]]
+        settings["temp_store"] = VALID_TEMP_STORES[settings["temp_store"]]
+        settings["journal_mode"] = settings["journal_mode"].upper()
+        return settings
+
+    @property
+    def tables(self):
+        """The database structure. Assign a new structure (rather than editing it) to update it."""
+        return self._tables
+
+    @tables.setter
+    def tables(self, database_structure):
+        # check the structure and index it before replacing the old one
+        schema = {}
+        for table_name, table in database_structure.items():
             self._assert_safe_name(table_name)
-            for key, data_type in table:
-                # support FOREIGN KEYs
-                match = foreignKeyPattern.match(key)
-                if match:
-                    key = match.group(1)
-                    self._assert_key_in_table(table_name, key)
+            schema[table_name] = self._build_table_schema(table_name, table)
+        self._tables = database_structure
+        self._schema = schema
 
-                self._assert_safe_name(key)
+        # the compiled SQL may be for the old structure
+        self._query_cache.clear()
+
+    def _build_table_schema(self, table_name, table):
+        """Check that all names in a table from the database structure are valid, and return its _TableSchema."""
+        foreignKeyPattern = re.compile(r"FOREIGN KEY \(([a-z_]\w*)\)", re.IGNORECASE)
+        uniqueKeyPattern = re.compile(r"(?:PRIMARY KEY|UNIQUE) \(([^)]*)\)$", re.IGNORECASE)
+        referencesPattern = re.compile(r"REFERENCES\s+([a-z_]\w*)\s*(?:\(\s*([a-z_]\w*)\s*\))?", re.IGNORECASE)
+        indexPattern = re.compile(r"(UNIQUE )?INDEX ([a-z_]\w*)$", re.IGNORECASE)
+        indexKeysPattern = re.compile(r"\(([^)]*)\)\s*(WHERE\s+.+)?$", re.IGNORECASE | re.DOTALL)
+
+        schema = _TableSchema(table_name)
+        get_list = []
+        definition = []
+        constraints = []
+        for key, data_type in table:
+            # indexes aren't part of the CREATE TABLE statement
+            match = indexPattern.match(key)
+            if match:
+                constraints.append((key, data_type))
+                continue
+            definition.append((key, data_type))
+            if re.search(r"\bCHECK\b", key + " " + data_type, re.IGNORECASE):
+                schema.checks = True
+            if re.search(r"\bAUTOINCREMENT\b", data_type, re.IGNORECASE):
+                schema.autoincrement = True
+
+            # table constraints are checked once all the columns are known
+            if self.safeNamePattern.match(key) == None:
+                constraints.append((key, data_type))
+                continue
+
+            schema.columns[key.lower()] = key
+            schema.types[key.lower()] = data_type
+            schema.typecodes[key.lower()] = _column_typecode(data_type)
+            get_list.append(key)
+            # an INTEGER PRIMARY KEY is the rowid, which SQLite fills in
+            if (re.search(r"\bNOT\s+NULL\b", data_type, re.IGNORECASE) and not re.search(r"\bDEFAULT\b", data_type, re.IGNORECASE)
+                    and not re.match(r"\s*INTEGER\s+PRIMARY\s+KEY\b", data_type, re.IGNORECASE)):
+                schema.required.add(key.lower())
+
+            if re.search(r"\b(PRIMARY KEY|UNIQUE)\b", data_type, re.IGNORECASE):
+                schema.unique_keys[frozenset((key.lower(),))] = (key,)
+            match = referencesPattern.search(data_type)
+            if match:
+                schema.foreign_keys.append((key, match.group(1), match.group(2)))
+        schema.get_list = tuple(get_list)
+        # join list of key:datatypes tuples into KEY DATATYPE, KEY DATATYPE, ...
+        schema.definition = ", ".join(" ".join(x) for x in definition)
+
+        for key, data_type in constraints:
+            # support INDEX name and UNIQUE INDEX name, e.g. ("INDEX books_by_author", "(author, pages DESC)")
+            # partial indexes have a WHERE clause after the keys, e.g. "(author) WHERE pages > 100"
+            match = indexPattern.match(key)
+            if match:
+                unique, name = match.groups()
+                self._assert_safe_name(name)
+                keys_match = indexKeysPattern.match(data_type.strip())
+                if not keys_match:
+                    raise SyntaxError("Index '{}' is not valid. Format is (key, key DESC, ...) with an optional WHERE clause.".format(name))
+
+                keys = []
+                for k in keys_match.group(1).split(","):
+                    k = k.split()
+                    if not k or len(k) > 2 or (len(k) == 2 and not k[1].upper() in VALID_SORTING):
+                        raise SyntaxError("Index '{}' is not valid. Each key must be a column name with an optional ASC or DESC.".format(name))
+                    self._assert_key_in_schema(schema, k[0])
+                    keys.append(k[0])
+
+                # a full (not partial) unique index can be used for native upserts
+                if unique and not keys_match.group(2):
+                    schema.unique_keys[frozenset(k.lower() for k in keys)] = tuple(keys)
+                schema.indexes.append((name, "CREATE {}INDEX IF NOT EXISTS {} ON {} {}".format(
+                    "UNIQUE " if unique else "", name, table_name, data_type.strip())))
+                continue
+
+            # support PRIMARY KEY (a, b) and UNIQUE (a, b)
+            match = uniqueKeyPattern.match(key)
+            if match:
+                keys = tuple(k.strip() for k in match.group(1).split(","))
+                for k in keys:
+                    self._assert_safe_name(k)
+                    self._assert_key_in_schema(schema, k)
+                schema.unique_keys[frozenset(k.lower() for k in keys)] = keys
+                continue
+
+            # support FOREIGN KEYs
+            match = foreignKeyPattern.match(key)
+            if match:
+                self._assert_key_in_schema(schema, match.group(1))
+                references = referencesPattern.search(data_type)
+                schema.foreign_keys.append((match.group(1), references.group(1) if references else None,
+                                            references.group(2) if references else None))
+                continue
+
+            self._assert_safe_name(key)
+        return schema
 
     def _assert_safe_name(self, name):
         """Check that name is allowed (alphanumeric, underscores and doesn't start with a digit)."""
@@ -112,28 +982,46 @@ class Database:
         if not comparison_type in VALID_COMPARISONS:
             raise InvalidComparisonType("Comparison type '{}' is not valid. ".format(comparison_type) +
                 "Valid comparison types are defined as: EQUAL [EQ], NOTEQUAL [NEQ], LESSTHAN [LT], "
-                "LESSTHANOREQUAL [LTEQ], GREATERTHAN [GT], GREATERTHANOREQUAL [GTEQ]")
+                "LESSTHANOREQUAL [LTEQ], GREATERTHAN [GT], GREATERTHANOREQUAL [GTEQ], IN, NOTIN, BETWEEN, LIKE, GLOB")
 
     def _assert_valid_sorting_type(self, sorting_type):
         """Check that sorting type is valid."""
         if not sorting_type in VALID_SORTING:
-            raise InvalidSortingType("Sorting type '{}' is not valid. ".format(comparison_type) +
+            raise InvalidSortingType("Sorting type '{}' is not valid. ".format(sorting_type) +
                 "Valid comparison types are defined as: ASC, DESC")
 
+    def _assert_valid_row_type(self, row_type):
+        """Check that row type is valid."""
+        if not row_type in VALID_ROW_TYPES:
+            raise InvalidRowType("Row type '{}' is not valid. ".format(row_type) +
+                "Valid row types are defined as: DICT, TUPLE, NAMEDTUPLE, ROW")
+
+    def _assert_valid_aggregate_type(self, aggregate_type):
+        """Check that aggregate type is valid."""
+        if not aggregate_type in VALID_AGGREGATES:
+            raise InvalidAggregateType("Aggregate type '{}' is not valid. ".format(aggregate_type) +
+                "Valid aggregate types are defined as: COUNT, SUM, AVG [AVERAGE], MIN [MINIMUM], MAX [MAXIMUM]")
+
+    def _assert_valid_file_format(self, file_format):
+        """Check that file format is valid."""
+        if not file_format in VALID_FILE_FORMATS:
+            raise InvalidFileFormat("File format '{}' is not valid. ".format(file_format) +
+                "Valid file formats are defined as: CSV, JSONL")
+
     def _assert_table_in_database_structure(self, table_name):
         """Check that table is in the database structure."""
-        if not table_name in self.tables:
+        if not table_name in self._schema:
             raise TableNotInDatabase("Table '{}' is not in the database (is missing from the database structure).".format(table_name))
 
     def _assert_key_in_table(self, table_name, key):
         """Check that key is in the table in the database structure."""
+        self._assert_key_in_schema(self._schema[table_name], key)
+
+    def _assert_key_in_schema(self, schema, key):
+        """Check that key is in the table's _TableSchema."""
         key = key.lower()
-        if key == "rowid": # allow "rowid" in any table
-            return
-        for k, data_type in self.tables[table_name]:
-            if k.lower() == key:
-                return
-        raise KeyNotInTable("Key '{}' is not in the table (is missing from '{}' in the database structure).".format(key, table_name))
+        if not key in schema.columns and key != "rowid": # allow "rowid" in any table
+            raise KeyNotInTable("Key '{}' is not in the table (is missing from '{}' in the database structure).".format(key, schema.name))
 
     def _process_select_dict(self, table_name, select_dict_orig):
         """Check that all key:values are valid and have a comparison type."""
@@ -141,6 +1029,13 @@ class Database:
         select_dict = dict(select_dict_orig)
 
         for k, v in select_dict.items():
+            # OR matches if any of a list of selection dictionaries match, e.g. {OR: [{"author":"Bob"}, {"pages":100}]}
+            if k == OR:
+                if not isinstance(v, (list, tuple)) or not all(isinstance(x, dict) for x in v):
+                    raise SyntaxError("OR needs a list of selection dictionaries.")
+                select_dict[k] = ([self._process_select_dict(table_name, x) for x in v], OR)
+                continue
+
             # make sure all values have their comparison type (EQUAL, GREATERTHAN, etc.)
             if isinstance(v, tuple):
                 if len(v) != 2:
@@ -148,6 +1043,12 @@ class Database:
                 # check that the comparison type is valid
                 self._assert_valid_comparison_type(v[1])
 
+                # check the comparisons that take more than one value
+                if v[1] in (IN, NOTIN) and not isinstance(v[0], (list, tuple, set, frozenset)):
+                    raise SyntaxError("IN needs a list of values. Format is ([value, ...], IN).")
+                if v[1] == BETWEEN and (not isinstance(v[0], (list, tuple)) or len(v[0]) != 2):
+                    raise SyntaxError("BETWEEN needs two values. Format is ((low, high), BETWEEN).")
+
             else:
                 v = (v, EQUAL)
                 select_dict[k] = v
@@ -162,25 +1063,611 @@ class Database:
 
         return select_dict
 
+    def _select_shape(self, select_dict):
+        """Return a hashable (key, comparison) tuple describing the columns and comparisons of a selection dictionary.
+
+        Selection dictionaries with the same shape produce the same SQL, only the values differ.
+        Invalid entries are not checked here, _process_select_dict raises for them.
+        """
+        shape = []
+        for k, v in select_dict.items():
+            if k == OR:
+                if isinstance(v, (list, tuple)) and all(isinstance(x, dict) for x in v):
+                    shape.append((k, (OR, tuple(self._select_shape(x) for x in v))))
+                else:
+                    shape.append((k, None))
+                continue
+            if isinstance(v, tuple):
+                if len(v) != 2:
+                    shape.append((k, None))
+                    continue
+                v, c = v
+            else:
+                c = EQUAL
+            # the SQL depends on the number of values in an IN list, and the shape of an invalid value must differ
+            # from a valid one, as _process_select_dict only checks a shape that isn't in the query cache
+            if c in (IN, NOTIN):
+                valid = isinstance(v, (list, tuple, set, frozenset))
+                c = (c, valid, _in_list_size(v) if valid else None)
+            elif c == BETWEEN:
+                c = (c, isinstance(v, (list, tuple)) and len(v) == 2)
+            # NULLs are compared differently (see _process_select_dict)
+            elif v is None:
+                c = "IS" if c == EQUAL else "IS NOT"
+            shape.append((k, c))
+        return tuple(shape)
+
+    def _where_terms(self, table_name, select_dict):
+        """Return a list of the conditions in a processed selection dictionary, which must all match."""
+        # make a list of things to match, and their match type (>, =, etc.)
+        select = []
+        for k in select_dict:
+            v, c = select_dict[k] # (value, comparison_type)
+            if c == OR:
+                # an empty selection dictionary matches everything, an empty OR list matches nothing
+                groups = ["(" + (" AND ".join(self._where_terms(table_name, x)) or "1") + ")" for x in v]
+                select.append("(" + " OR ".join(groups) + ")" if groups else "0")
+            elif c in (IN, NOTIN):
+                size = _in_list_size(v)
+                if size is None:
+                    # like IN (?, ...), the values are compared with the column's affinity. Numeric affinities are
+                    # applied to the values by the comparison, TEXT isn't (as json_each's value column has an affinity)
+                    affinity = _column_affinity(self._schema[table_name].types.get(k.lower(), "INTEGER"))  # or rowid
+                    value = "CAST(value AS TEXT)" if affinity == "TEXT" else "value"
+                    select.append("{} {} (SELECT {} FROM json_each(?))".format(k, c, value))
+                    continue
+                # long lists are split into groups: k IN (...) OR k IN (...), or k NOT IN (...) AND k NOT IN (...)
+                groups = ["{} {} ({})".format(k, c, ", ".join(["?"] * min(size - i, _IN_LIST_MAX)))
+                          for i in range(0, size, _IN_LIST_MAX)] or ["{} {} ()".format(k, c)]
+                joined = (" OR " if c == IN else " AND ").join(groups)
+                select.append("(" + joined + ")" if len(groups) > 1 else joined)
+            elif c == BETWEEN:
+                select.append("{} BETWEEN ? AND ?".format(k))
+            else:
+                select.append("{} {} ?".format(k, c))
+        return select
+
+    def _where_clause(self, table_name, select_dict):
+        """Return the WHERE clause (or an empty string) for a processed selection dictionary.
+
+        The parameters are the selection dictionary values, see _select_params.
+        """
+        select = self._where_terms(table_name, select_dict)
+        return " WHERE " + " AND ".join(select) if select else ""
+
+    def _upsert_sql(self, table_name, select_dict, put_keys, returning):
+        """Return a single statement INSERT ... ON CONFLICT DO UPDATE for a put, or None if it can't be used.
+
+        This is only possible when the selection dictionary is exactly a PRIMARY KEY or UNIQUE key, every
+        comparison is EQUAL (NULLs are never a conflict) and put_dict doesn't overwrite any of the selected keys.
+        SQLite checks the row being inserted before it finds the conflict, so it isn't used for tables with
+        NOT NULL columns (without a DEFAULT) that aren't being put or selected, or with CHECK constraints, where
+        updating an existing row could fail. Nor for AUTOINCREMENT tables, where every update would use up an id.
+        The parameters are the put_dict values followed by the select_dict values.
+        """
+        if not _SQLITE_HAS_UPSERT or (returning and not _SQLITE_HAS_RETURNING):
+            return None
+        if any(c != EQUAL for _, c in select_dict.values()):
+            return None
+
+        select_keys = frozenset(k.lower() for k in select_dict)
+        put_keys_lower = set(k.lower() for k in put_keys)
+        if select_keys & put_keys_lower:
+            return None
+        schema = self._schema[table_name]
+        if schema.checks or schema.autoincrement or schema.required - select_keys - put_keys_lower:
+            return None
+        unique_key = schema.unique_keys.get(select_keys)
+        if not unique_key:
+            return None
+
+        columns = list(put_keys) + list(select_dict)
+        # DO UPDATE needs at least one column to set, or RETURNING won't return the existing row
+        update = ", ".join("{0} = excluded.{0}".format(k) for k in (put_keys or unique_key[:1]))
+        return "INSERT INTO {} ({}) VALUES ({}) ON CONFLICT ({}) DO UPDATE SET {}{}".format(
+            table_name, ", ".join(columns), ", ".join(["?"] * len(columns)),
+            ", ".join(unique_key), update, " RETURNING rowid" if returning else "")
+
+    def _cached_query(self, key, compile, *args):
+        """Return the compiled query for key from the query cache, calling compile(*args) if it isn't there."""
+        query = self._query_cache.get(key)
+        if query is None:
+            query = compile(*args)
+            self._query_cache.set(key, query)
+        return query
+
+    def _process_sort_by(self, table_name, sort_by, aliases=()):
+        """Check that all sort keys are valid and return them as a list of (key, ASC or DESC) tuples.
+
+        aliases -- Names that can be sorted by as well as the table's keys (e.g. aggregate results).
+        """
+        if not sort_by:
+            return []
+
+        # if sort by is a column name
+        if isinstance(sort_by, str):
+            sort_by = [(sort_by, ASC)]
+        # if sort by is a single tuple
+        elif len(sort_by) == 2 and sort_by[1] in VALID_SORTING:
+            sort_by = [tuple(sort_by)]
+        else:
+            sort_by = list(sort_by)
+
+        # sort by is a list of tuples
+        for i, k in enumerate(sort_by):
+            # make sure all values have their sorting type (ASC or DESC)
+            if isinstance(k, tuple):
+                if len(k) != 2:
+                    raise SyntaxError("Incorrect number of values in tuple. Format is (key, ASC or DESC).")
+                # check that the key and comparison type are valid
+                if not k[0] in aliases:
+                    self._assert_key_in_table(table_name, k[0])
+                self._assert_valid_sorting_type(k[1])
+
+            else:
+                sort_by[i] = (k, ASC)
+                if not k in aliases:
+                    self._assert_key_in_table(table_name, k)
+        return sort_by
+
+    def _compile_select(self, table_name, select_dict, get_list, sort_by, limit=False, offset=False, page=False, after=False):
+        """Check a get_all query and return its SQL and the list of columns it returns.
+
+        limit, offset -- Add LIMIT ? and OFFSET ? (their parameters go after the select_dict values).
+        page          -- Order by rowid after sort_by, and add the sort keys & rowid to the end of the columns.
+        after         -- Only match rows after a page's last row (its sort keys & rowid are the parameters after
+                         the select_dict values, see _seek_params).
+        """
+        self._assert_table_in_database_structure(table_name)
+
+        # make sure everything in the select_dict is valid
+        select_dict = self._process_select_dict(table_name, select_dict)
+
+        # make sure get_list is valid, get all by default
+        if get_list:
+            for k in set(get_list):
+                self._assert_key_in_table(table_name, k)
+        else:
+            get_list = self._schema[table_name].get_list
+
+        sort_by = self._process_sort_by(table_name, sort_by)
+        columns = list(get_list)
+        if page:
+            # keyset pagination continues after the last row of the previous page, so the order must be unique
+            sort_by.append(("rowid", ASC))
+            columns += [k for k, _ in sort_by]
+
+        # make strings to send to SQL
+        select = self._where_clause(table_name, select_dict)
+        if after:
+            # (a > ?) OR (a = ? AND b < ?) OR (a = ? AND b = ? AND rowid > ?) for [(a, ASC), (b, DESC), (rowid, ASC)]
+            seek = []
+            for i, (k, direction) in enumerate(sort_by):
+                terms = ["{} = ?".format(x) for x, _ in sort_by[:i]] + ["{} {} ?".format(k, GT if direction == ASC else LT)]
+                seek.append("(" + " AND ".join(terms) + ")")
+            select += (" AND " if select else " WHERE ") + "(" + " OR ".join(seek) + ")"
+        get    = ", ".join(columns)
+        sort   = " ORDER BY " + ", ".join(" ".join(x) for x in sort_by) if sort_by else ""
+        if limit:
+            sort += " LIMIT ?"
+        if offset:
+            # SQLite only allows OFFSET after a LIMIT, -1 is no limit
+            sort += " OFFSET ?" if limit else " LIMIT -1 OFFSET ?"
+        return _SelectQuery("SELECT {} FROM {}{}{}".format(get, table_name, select, sort), tuple(get_list))
+
+    def _compile_aggregate(self, table_name, select_dict, aggregates, group_by, sort_by):
+        """Check an aggregate query and return its SQL and the list of columns it returns (group_by keys, then aliases)."""
+        self._assert_table_in_database_structure(table_name)
+
+        # make sure everything in the select_dict is valid
+        select_dict = self._process_select_dict(table_name, select_dict)
+
+        # group by is a column name or a list of them
+        if isinstance(group_by, str):
+            group_by = [group_by]
+        group_by = list(group_by or [])
+        for k in group_by:
+            self._assert_key_in_table(table_name, k)
+
+        columns = list(group_by)
+        for alias, aggregate in aggregates.items():
+            if not isinstance(aggregate, tuple) or len(aggregate) != 2:
+                raise SyntaxError("Incorrect number of values in tuple. Format is {alias: (AGGREGATE_TYPE, key)}.")
+            function, k = aggregate
+            self._assert_safe_name(alias)
+            self._assert_valid_aggregate_type(function)
+            # only COUNT can count every row
+            if not (function == COUNT and k == "*"):
+                self._assert_key_in_table(table_name, k)
+            columns.append("{}({}) AS {}".format(function, k, alias))
+
+        sort_by = self._process_sort_by(table_name, sort_by, aliases=aggregates)
+
+        # make strings to send to SQL
+        select = self._where_clause(table_name, select_dict)
+        group  = " GROUP BY " + ", ".join(group_by) if group_by else ""
+        sort   = " ORDER BY " + ", ".join(" ".join(x) for x in sort_by) if sort_by else ""
+        sql = "SELECT {} FROM {}{}{}{}".format(", ".join(columns), table_name, select, group, sort)
+        return _SelectQuery(sql, tuple(group_by) + tuple(aggregates))
+
+    def _compile_put(self, table_name, select_dict, put_keys, force_new_record):
+        """Check a put query and return the SQL for each of the ways it can be run.
+
+        The parameters are the put_dict values, followed by the select_dict values at the indexes in extra
+        (all of them for upsert & upsert_many), followed by the rowid for update.
+        """
+        # check that table name is valid
+        self._assert_table_in_database_structure(table_name)
+
+        # make sure everything in the select_dict is valid
+        select_dict_orig = select_dict
+        select_dict = self._process_select_dict(table_name, select_dict)
+
+        # check that all keys in put_dict are valid
+        for key in put_keys:
+            self._assert_key_in_table(table_name, key)
+
+        # everything in select_dict that isn't in put_dict is also put, unless it matches more than one value
+        # (extra is the position of its parameter in the select_dict parameters)
+        extra = []
+        columns = list(put_keys)
+        position = 0
+        for k, (v, c) in select_dict.items():
+            if not k in put_keys and c in (EQ, NEQ, GT, GTEQ, LT, LTEQ, "IS", "IS NOT"):
+                extra.append(position)
+                columns.append(k)
+            position += len(self._select_params({k: select_dict_orig[k]}))
+        extra = tuple(extra)
+
+        upsert = upsert_many = lookup = update = None
+        # an empty selection dictionary would match any record, so it always creates a new one
+        if not force_new_record and select_dict:
+            # use a single statement if selecting by a unique key
+            upsert = self._upsert_sql(table_name, select_dict, put_keys, returning=True)
+            upsert_many = self._upsert_sql(table_name, select_dict, put_keys, returning=False)
+
+            # otherwise check if there is already a record in the database, and update it
+            select = self._where_clause(table_name, select_dict)
+            lookup = "SELECT rowid FROM {}{} LIMIT 1".format(table_name, select)
+            update = "UPDATE {} SET {} WHERE rowid=?".format(table_name, ", ".join("{} = ?".format(k) for k in columns))
+
+        # or create a new record
+        insert = "INSERT INTO {} ({}) VALUES ({})".format(table_name, ", ".join(columns), ", ".join(["?"] * len(columns)))
+        return _PutQuery(upsert, upsert_many, lookup, update, insert, extra)
+
+    def _compile_delete(self, table_name, select_dict):
+        """Check a delete query and return its SQL."""
+        # check that table name is valid
+        self._assert_table_in_database_structure(table_name)
+
+        # an empty selection dictionary would match every record
+        if not select_dict:
+            raise SyntaxError("A delete needs a selection dictionary. Use reset_table to delete every record.")
+
+        # make sure everything in the select_dict is valid
+        select_dict = self._process_select_dict(table_name, select_dict)
+
+        select = self._where_clause(table_name, select_dict)
+        return "DELETE FROM {}{}".format(table_name, select)
+
+    def _select_query(self, table_name, select_dict, get_list, sort_by, limit=False, offset=False, page=False, after=False):
+        """Return the (cached) compiled get_all query."""
+        key = ("get", table_name, self._select_shape(select_dict), tuple(get_list) if get_list else None, _freeze(sort_by),
+               limit, offset, page, after)
+        return self._cached_query(key, self._compile_select, table_name, select_dict, get_list, sort_by, limit, offset, page, after)
+
+    def _select_params(self, select_dict, limit=None, offset=None):
+        """Return the values of a selection dictionary, in the order used by _where_clause, then the limit & offset."""
+        params = []
+        for k, v in select_dict.items():
+            if k == OR:
+                for x in v:
+                    params.extend(self._select_params(x))
+            elif not isinstance(v, tuple):
+                params.append(v)
+            elif v[1] in (IN, NOTIN):
+                values = list(v[0])
+                size = _in_list_size(values)
+                if size is None:
+                    params.append(json.dumps(values))
+                else:
+                    params.extend(values + values[-1:] * (size - len(values)))
+            elif v[1] == BETWEEN:
+                params.extend(v[0])
+            else:
+                params.append(v[0])
+        if limit is not None:
+            params.append(limit)
+        if offset is not None:
+            params.append(offset)
+        return params
+
+    def _seek_params(self, token):
+        """Return the parameters for a keyset pagination token (the last row's sort keys & rowid), see _compile_select."""
+        params = []
+        for i in range(len(token)):
+            params.extend(token[:i + 1])
+        return params
+
+    def _aggregate_query(self, table_name, select_dict, aggregates, group_by, sort_by):
+        """Return the (cached) compiled aggregate query."""
+        key = ("aggregate", table_name, self._select_shape(select_dict), _freeze(aggregates), _freeze(group_by), _freeze(sort_by))
+        return self._cached_query(key, self._compile_aggregate, table_name, select_dict, aggregates, group_by, sort_by)
+
+    def _put_query(self, table_name, select_dict, put_keys, force_new_record):
+        """Return the (cached) compiled put query."""
+        key = ("put", table_name, self._select_shape(select_dict), put_keys, force_new_record)
+        return self._cached_query(key, self._compile_put, table_name, select_dict, put_keys, force_new_record)
+
+    def _delete_query(self, table_name, select_dict):
+        """Return the (cached) compiled delete query."""
+        key = ("delete", table_name, self._select_shape(select_dict))
+        return self._cached_query(key, self._compile_delete, table_name, select_dict)
+
+    def _checkout_reader(self):
+        """Check out a reader connection from the pool for the current thread.
+
+        Reads made while the thread already has one checked out (e.g. inside an iter_all loop) share it rather
+        than waiting for the pool, so a thread never holds more than one reader and can't deadlock on itself.
+        RETURN >>> >>> (connection, release) call release() once (from any thread) when finished with it.
+        """
+        ident = threading.current_thread().ident
+        with self._checkouts_lock:
+            checkout = self._checkouts.get(ident)
+            if checkout is not None:
+                checkout[1] += 1
+        if checkout is None:
+            checkout = [self._readers.get(), 1]
+            with self._checkouts_lock:
+                self._checkouts[ident] = checkout
+
+        def release():
+            with self._checkouts_lock:
+                checkout[1] -= 1
+                if checkout[1]:
+                    return
+                if self._checkouts.get(ident) is checkout:
+                    del self._checkouts[ident]
+            self._readers.put(checkout[0])
+        return checkout[0], release
+
+    @contextmanager
+    def _reader(self):
+        """Check out a cursor to read with, from the reader pool if there is one, otherwise the database cursor."""
+        if self._readers is None:
+            yield self.c
+            return
+
+        conn, release = self._checkout_reader()
+        try:
+            yield conn.cursor()
+        finally:
+            release()
+
+    @contextmanager
+    def _atomic(self):
+        """Run the enclosed statements in a single transaction, undoing all of them if an exception is raised.
+
+        Uses a savepoint so it can be nested. Changes still need to be committed to be saved.
+        """
+        name = "sqlite3_wrapper_{}".format(self._savepoint_depth)
+        if not self.conn.in_transaction:
+            self._execute(self.c, "BEGIN")
+        self._execute(self.c, "SAVEPOINT " + name)
+        self._savepoint_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._savepoint_depth -= 1
+            self._execute(self.c, "ROLLBACK TO " + name)
+            self._execute(self.c, "RELEASE " + name)
+            self._invalidate_dirty_tables()
+            raise
+        self._savepoint_depth -= 1
+        self._execute(self.c, "RELEASE " + name)
+
+    def _execute(self, cursor, sql, params=()):
+        """Execute a statement on cursor, reporting it to the hook (if there is one)."""
+        if self.hook is None:
+            return cursor.execute(sql, params)
+        start = time.perf_counter()
+        cursor.execute(sql, params)
+        # rowcount is the number of rows changed, or -1 for a query
+        self._report(cursor, sql, params, len(params), cursor.rowcount if cursor.rowcount >= 0 else None, start)
+        return cursor
+
+    def _executemany(self, cursor, sql, seq_of_params):
+        """Execute a statement for each set of parameters on cursor, reporting it to the hook (if there is one)."""
+        if self.hook is None:
+            return cursor.executemany(sql, seq_of_params)
+        # count the parameter sets as executemany uses them, they can be a generator
+        param_count = [0]
+        def counted():
+            for param_count[0], params in enumerate(seq_of_params, 1):
+                yield params
+        start = time.perf_counter()
+        cursor.executemany(sql, counted())
+        self._report(cursor, sql, None, param_count[0], cursor.rowcount, start)
+        return cursor
+
+    def _fetch_all(self, cursor, sql, params=()):
+        """Execute a query on cursor and return all of its rows, reporting it to the hook (if there is one)."""
+        if self.hook is None:
+            return cursor.execute(sql, params).fetchall()
+        start = time.perf_counter()
+        rows = cursor.execute(sql, params).fetchall()
+        self._report(cursor, sql, params, len(params), len(rows), start)
+        return rows
+
+    def _report(self, cursor, sql, params, param_count, rows, start):
+        """Call the hook with a QueryEvent for a statement that started at start (a time.perf_counter)."""
+        seconds = time.perf_counter() - start
+        explain = None
+        if params is not None:
+            conn = cursor.connection
+            explain = lambda: [row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+        hook = self.hook
+        if hook is not None:
+            hook(QueryEvent(sql, params, param_count, rows, seconds, explain))
+
+    def _wrote(self, count=1):
+        """Count writes, and commit if batch_writes or batch_interval has been reached (outside transactions)."""
+        if not self.batch_writes and self.batch_interval is None:
+            return
+        with self._write_lock:
+            if self._first_uncommitted_write is None:
+                self._first_uncommitted_write = time.time()
+            self._uncommitted_writes += count
+            if self._savepoint_depth:
+                return
+            if (self.batch_writes and self._uncommitted_writes >= self.batch_writes) or \
+               (self.batch_interval is not None and (time.time() - self._first_uncommitted_write) * 1000 >= self.batch_interval):
+                self.commit()
+            elif self.batch_interval is not None and self._commit_timer is None:
+                self._start_commit_timer()
+
+    def _start_commit_timer(self):
+        """Start a timer to commit when the oldest uncommitted write is batch_interval milliseconds old."""
+        wait = self._first_uncommitted_write + self.batch_interval / 1000.0 - time.time()
+        self._commit_timer = threading.Timer(max(wait, 0), self._timed_commit)
+        # don't keep the program running just to commit
+        self._commit_timer.daemon = True
+        self._commit_timer.start()
+
+    def _timed_commit(self):
+        """Commit the batched writes, if they haven't been committed already (runs on the timer thread)."""
+        with self._write_lock:
+            self._commit_timer = None
+            if self._first_uncommitted_write is None:
+                return
+            if (time.time() - self._first_uncommitted_write) * 1000 >= self.batch_interval:
+                self.commit()
+            else:
+                # committed since the timer started, wait for the writes made after that
+                self._start_commit_timer()
+
+    def _changed(self, table_name):
+        """Clear the table's result cache before it is written to (and again when the change is committed or rolled back)."""
+        cache = self._result_caches.get(table_name)
+        if cache is not None:
+            cache.clear()
+            self._dirty_tables.add(table_name)
+
+    def _invalidate_dirty_tables(self):
+        """Clear the result caches of the tables written to since the last commit."""
+        for table_name in self._dirty_tables:
+            self._result_caches[table_name].clear()
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in a transaction, commit when the outermost transaction() block ends.
+
+        If an exception is raised the block's changes are rolled back (and the exception is re-raised).
+        Blocks can be nested, an inner block uses a savepoint so only its own changes are rolled back.
+        Changes made before the outermost block (that haven't been committed yet) are committed with it.
+        Writes from other threads wait until the outermost block ends.
+        e.g. with db.transaction():
+                 db.put(...)
+        """
+        with self._write_lock:
+            # nested, the outermost block will commit
+            if self._savepoint_depth:
+                with self._atomic():
+                    yield
+                return
+
+            began = not self.conn.in_transaction
+            try:
+                with self._atomic():
+                    yield
+            except BaseException:
+                # end the transaction too if this block started it
+                if began:
+                    self.conn.rollback()
+                    self._invalidate_dirty_tables()
+                    self._dirty_tables.clear()
+                raise
+            self.commit()
+
     def cursor(self):
         """Return a reference to the database cursor."""
         return self.c
 
+    def query_cache_info(self):
+        """Return the query cache statistics: a dictionary of hits, misses, size and maxsize."""
+        return self._query_cache.info()
+
+    def cache_table(self, table_name, maxsize=1000, ttl=None, max_bytes=64 * 1024 * 1024):
+        """Cache the results of get_all (and get) for the table, until the table is written to.
+
+        Use it for small tables that are read far more often than they are written. Results are cleared
+        by any put, post, delete, bulk function, reset_table or delete_table on the table through this
+        Database (and again when that change is committed or rolled back). Changes made by other
+        programs (or other Database objects) aren't seen until the results expire.
+        Cached results are shared, so get_all returns copies of the row dictionaries.
+
+        table_name  -- The table name to cache.
+        maxsize     -- The maximum number of results to keep (0 to stop caching the table).
+        ttl         -- How long to keep each result, in milliseconds. Defaults to until the table changes.
+        max_bytes   -- The maximum (estimated) memory used by the cached rows.
+        """
+        self._assert_table_in_database_structure(table_name)
+        with self._write_lock:
+            if maxsize <= 0:
+                self._result_caches.pop(table_name, None)
+                self._dirty_tables.discard(table_name)
+            else:
+                self._result_caches[table_name] = _ResultCache(maxsize, ttl, max_bytes)
+
+    def result_cache_info(self, table_name):
+        """Return the table's result cache statistics (see cache_table), or None if it isn't cached.
+
+        RETURN >>> >>> A dictionary of hits, misses, evictions, invalidations, size, maxsize, bytes and max_bytes
+        """
+        cache = self._result_caches.get(table_name)
+        return cache.info() if cache is not None else None
+
     def commit(self):
-        """Commit changes to the database."""
-        self.conn.commit()
+        """Commit changes to the database. Does nothing inside a transaction(), it commits when it ends."""
+        with self._write_lock:
+            if self._savepoint_depth:
+                return
+            self.conn.commit()
+            self._uncommitted_writes = 0
+            self._first_uncommitted_write = None
+            # pooled readers could have cached the old rows while the changes were uncommitted
+            self._invalidate_dirty_tables()
+            self._dirty_tables.clear()
 
     def close(self):
-        """Close database without saving. Commit first to save changes."""
-        self.conn.close()
+        """Close database without saving. Commit first to save changes.
+
+        If batch_writes or batch_interval is set, the uncommitted writes are committed first.
+        Runs PRAGMA optimize, which updates the query planner's statistics if the queries run would benefit.
+        """
+        with self._write_lock:
+            if self._commit_timer is not None:
+                self._commit_timer.cancel()
+                self._commit_timer = None
+            if self.batch_writes or self.batch_interval is not None:
+                self.commit()
+            try:
+                self._execute(self.c, "PRAGMA optimize")
+            except sqlite3.OperationalError:
+                # e.g. the database is read only or locked, it's only an optimisation
+                pass
+            self.conn.close()
+            while self._readers is not None and not self._readers.empty():
+                self._readers.get().close()
 
     def create_table(self, table_name):
-        """Create the table using information from the database structure."""
-        self._assert_table_in_database_structure(table_name)
-        # join list of key:datatypes tuples into KEY DATATYPE, KEY DATATYPE, ...
-        params = ', '.join(" ".join(x) for x in self.tables[table_name])
-        if _DEBUG: print("@SQL CREATE TABLE IF NOT EXISTS {} ({})".format(table_name, params))
-        self.c.execute("CREATE TABLE IF NOT EXISTS {} ({})".format(table_name, params))
+        """Create the table (and its indexes) using information from the database structure."""
+        with self._write_lock:
+            self._assert_table_in_database_structure(table_name)
+            schema = self._schema[table_name]
+            self._execute(self.c, "CREATE TABLE IF NOT EXISTS {} ({})".format(table_name, schema.definition))
+            for _, sql in schema.indexes:
+                self._execute(self.c, sql)
         
     def create_all_tables(self):
         """Create all the tables in the database structure."""
@@ -189,9 +1676,10 @@ class Database:
 
     def delete_table(self, table_name):
         """Delete the table if it exists."""
-        self._assert_table_in_database_structure(table_name)
-        if _DEBUG: print("@SQL DROP TABLE IF EXISTS {}".format(table_name))
-        self.c.execute("DROP TABLE IF EXISTS {}".format(table_name))
+        with self._write_lock:
+            self._assert_table_in_database_structure(table_name)
+            self._changed(table_name)
+            self._execute(self.c, "DROP TABLE IF EXISTS {}".format(table_name))
         
     def delete_all_tables(self):
         """Delete all the tables in the database structure."""
@@ -200,9 +1688,10 @@ class Database:
 
     def reset_table(self, table_name):
         """Remove every row from the table."""
-        self._assert_table_in_database_structure(table_name)
-        if _DEBUG: print("@SQL DELETE FROM {}".format(table_name))
-        self.c.execute("DELETE FROM {}".format(table_name))
+        with self._write_lock:
+            self._assert_table_in_database_structure(table_name)
+            self._changed(table_name)
+            self._execute(self.c, "DELETE FROM {}".format(table_name))
         
     def reset_all_tables(self):
         """Reset all the tables in the database structure."""
@@ -211,12 +1700,24 @@ class Database:
 
     def table_exists(self, table_name):
         """Determine whether the table exists."""
-        self._assert_table_in_database_structure(table_name)
-        if _DEBUG: print("@SQL SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-        self.c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))
-        return self.c.fetchone() != False
-
-    def get_all(self, table_name, select_dict, get_list=None, sort_by=None):
+        with self._reader() as c:
+            self._assert_table_in_database_structure(table_name)
+            return len(self._fetch_all(c, "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (table_name,))) > 0
+
+    def _namedtuple_class(self, get_list):
+        """Return the (cached) namedtuple class for the NAMEDTUPLE row type."""
+        if not get_list in self._namedtuples:
+            self._namedtuples[get_list] = namedtuple("Row", get_list, rename=True)
+        return self._namedtuples[get_list]
+
+    def _row_class(self, table_name, get_list):
+        """Return the (cached) _Row class for the ROW row type."""
+        key = (table_name, get_list)
+        if not key in self._row_classes:
+            self._row_classes[key] = _make_row_class(table_name, get_list)
+        return self._row_classes[key]
+
+    def get_all(self, table_name, select_dict, get_list=None, sort_by=None, limit=None, offset=None, row_type=DICT):
         """Get all records that match all key:values in the selection dictionary.
 
         table_name  -- The table name to search for matches in.
@@ -225,83 +1726,282 @@ class Database:
         get_list    -- A list of columns to return. Defaults to return all columns.
         sort_by     -- A list of tuples to order the results by.
                        e.g. [("author",DESCENDING), ("pages":ASCENDING)]
-        RETURN >>> >>> A list (of matches) of dictionaries containing the requested columns.
+        limit       -- The maximum number of records to return. Defaults to return all records.
+        offset      -- The number of records to skip. For deep pages use get_page instead, which doesn't
+                       need SQLite to step over the skipped records.
+        row_type    -- The type of each match: DICT, TUPLE, NAMEDTUPLE or ROW (columns are in get_list order).
+                       ROW is the smallest and fastest to make that can still be read by column name, see _Row.
+        RETURN >>> >>> A list (of matches) of dictionaries (or row_type) containing the requested columns.
         """
-        self._assert_table_in_database_structure(table_name)
+        self._assert_valid_row_type(row_type)
+        cache = self._result_caches.get(table_name)
+        if cache is not None:
+            key = (tuple(sorted((k, _freeze(v)) for k, v in select_dict.items())),
+                   tuple(get_list) if get_list else None, _freeze(sort_by), limit, offset, row_type)
+            cached = cache.get(key)
+            if cached is not None:
+                # only dictionaries can be changed
+                return [dict(row) for row in cached] if row_type == DICT else list(cached)
+            generation = cache.generation
+
+        with self._reader() as c:
+            query = self._select_query(table_name, select_dict, get_list, sort_by, limit is not None, offset is not None)
+            params = self._select_params(select_dict, limit, offset)
+            if row_type == ROW:
+                # a cursor of its own, so the row factory doesn't change anything else's rows
+                c = c.connection.cursor()
+                c.row_factory = self._row_class(table_name, query.get_list)
+            results = self._fetch_all(c, query.sql, params)
+
+            if row_type == DICT:
+                # make a list of dictionaries containing the requested results
+                get_list_of_dicts = []
+                for result in results:
+                    # results are {key:value} pairs in a dictionary
+                    get_list_of_dicts.append(dict(zip(query.get_list, result)))
+                results = get_list_of_dicts
+            elif row_type == NAMEDTUPLE:
+                results = list(map(self._namedtuple_class(query.get_list)._make, results))
+
+        if cache is not None:
+            cache.set(key, results, generation)
+            return [dict(row) for row in results] if row_type == DICT else list(results)
+        return results
+
+    def get(self, table_name, select_dict, get_list=None, sort_by=None, row_type=DICT):
+        """Get the first record that match all key:values in the selection dictionary.
 
-        # make sure everything in the select_dict is valid
-        select_dict = self._process_select_dict(table_name, select_dict)
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        get_list    -- A list of columns to return. Defaults to return all columns.
+        sort_by     -- A list of tuples to order the results by.
+                       e.g. [("author",DESCENDING), ("pages":ASCENDING)]
+        row_type    -- The type of the match: DICT, TUPLE, NAMEDTUPLE or ROW (columns are in get_list order).
+        RETURN >>> >>> A dictionaries (or row_type) containing the requested columns or None if there is no match.
+        """
+        # only ask the database for the first result
+        result = self.get_all(table_name, select_dict, get_list, sort_by, limit=1, row_type=row_type)
+        # return the first result if there is one
+        return result[0] if result else None
 
-        # make sure get_list is valid, get all by default
-        if get_list:
-            for k in set(get_list):
-                self._assert_key_in_table(table_name, k)
+    def get_page(self, table_name, select_dict, get_list=None, sort_by=None, page_size=100, token=None):
+        """Get a page of the records that match all key:values in the selection dictionary.
+
+        Uses keyset pagination, each page continues after the last row of the previous page (rather than
+        skipping over an offset) so every page is as fast as the first. The sort keys shouldn't contain NULLs.
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        get_list    -- A list of columns to return. Defaults to return all columns.
+        sort_by     -- A list of tuples to order the results by (ties are ordered by rowid).
+                       e.g. [("author",DESCENDING), ("pages":ASCENDING)]
+        page_size   -- The maximum number of records to return.
+        token       -- The token returned with the previous page, or None for the first page.
+        RETURN >>> >>> A tuple of (a list of dictionaries containing the requested columns, the token for the
+                       next page or None if this is the last page).
+        """
+        with self._reader() as c:
+            query = self._select_query(table_name, select_dict, get_list, sort_by, limit=True, page=True, after=token is not None)
+
+            # get one extra row to find out if there is another page
+            params = self._select_params(select_dict)
+            if token is not None:
+                params += self._seek_params(token)
+            params.append(page_size + 1)
+            results = self._fetch_all(c, query.sql, params)
+
+            # the sort keys & rowid are after the requested columns
+            n = len(query.get_list)
+            page = [dict(zip(query.get_list, result)) for result in results[:page_size]]
+            token = tuple(results[page_size - 1][n:]) if len(results) > page_size else None
+            return page, token
+
+    def iter_all(self, table_name, select_dict, get_list=None, sort_by=None, limit=None, offset=None, batch_size=1000, row_type=DICT):
+        """Iterate over all records that match all key:values in the selection dictionary.
+
+        Uses its own cursor and only holds batch_size rows in memory at a time. With a connection pool, one of
+        the readers is used from the first row until the generator is finished (or closed), and other reads
+        in the same thread share it. The query runs when the first row is asked for.
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        get_list    -- A list of columns to return. Defaults to return all columns.
+        sort_by     -- A list of tuples to order the results by.
+                       e.g. [("author",DESCENDING), ("pages":ASCENDING)]
+        limit       -- The maximum number of records to return. Defaults to return all records.
+        offset      -- The number of records to skip.
+        batch_size  -- The number of rows to fetch from the database at a time.
+        row_type    -- The type of each match: DICT, TUPLE, NAMEDTUPLE or ROW (columns are in get_list order).
+        RETURN >>> >>> A generator of matches containing the requested columns.
+        """
+        self._assert_valid_row_type(row_type)
+        query = self._select_query(table_name, select_dict, get_list, sort_by, limit is not None, offset is not None)
+
+        if row_type == DICT:
+            get_list = query.get_list
+            make_row = lambda row: dict(zip(get_list, row))
+        elif row_type == NAMEDTUPLE:
+            make_row = self._namedtuple_class(query.get_list)._make
+        elif row_type == ROW:
+            # made by the cursor's row factory
+            make_row = None
         else:
-            get_list = []
-            for x in self.tables[table_name]:
-                if not x[0].startswith("FOREIGN KEY"):
-                    get_list.append(x[0])
-
-        if sort_by:
-            # if sort by is a column name
-            if isinstance(sort_by, str):
-                sort_by = [(sort_by, ASC)]
-            # if sort by is a single tuple
-            elif len(sort_by) == 2 and sort_by[1] in VALID_SORTING:
-                sort_by = [tuple(sort_by)]
-
-            # sort by is a list of tuples
-            for i, k in enumerate(sort_by):
-                # make sure all values have their sorting type (ASC or DESC)
-                if isinstance(k, tuple):
-                    if len(k) != 2:
-                        raise SyntaxError("Incorrect number of values in tuple. Format is (key, ASC or DESC).")
-                    # check that the key and comparison type are valid
-                    self._assert_key_in_table(table_name, k[0])
-                    self._assert_valid_sorting_type(k[1])
+            make_row = tuple
+
+        row_factory = self._row_class(table_name, query.get_list) if row_type == ROW else None
+        params = self._select_params(select_dict, limit, offset)
+        return self._iter_query(query.sql, params, batch_size, make_row, row_factory)
 
+    def _iter_query(self, sql, params, batch_size, make_row, row_factory=None):
+        """Yield the rows of a query (see _iter_cursor), checking out a reader only once the first row is asked for.
+
+        A generator that is never started holds nothing, one that is started holds the reader until it finishes.
+        """
+        if self._readers is None:
+            cursor, release = self.conn.cursor(), None
+        else:
+            conn, release = self._checkout_reader()
+            cursor = conn.cursor()
+        cursor.row_factory = row_factory
+
+        try:
+            # only the execute is timed, the rows are read as the generator is used
+            self._execute(cursor, sql, params)
+        except BaseException:
+            cursor.close()
+            if release: release()
+            raise
+        rows = _iter_cursor(cursor, batch_size, make_row, release)
+        try:
+            for row in rows:
+                yield row
+        finally:
+            # closes the cursor & releases the reader as soon as this generator is closed
+            rows.close()
+
+    def get_columns(self, table_name, select_dict, get_list=None, sort_by=None, limit=None, offset=None,
+                    batch_size=10000, use_numpy=True):
+        """Get all records that match all key:values in the selection dictionary, as a column of values per key.
+
+        Much faster and smaller than get_all for large results, as the values are copied straight into arrays
+        rather than a dictionary per row. INTEGER columns are filled into array.array("q") and REAL columns into
+        array.array("d") (NULLs become NaN), or NumPy int64/float64 arrays if NumPy is installed. Other columns,
+        and INTEGER columns containing NULLs or other types, are lists (or NumPy object arrays).
+        The column types are taken from the declared types in the database structure.
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        get_list    -- A list of columns to return. Defaults to return all columns.
+        sort_by     -- A list of tuples to order the results by.
+                       e.g. [("author",DESCENDING), ("pages":ASCENDING)]
+        limit       -- The maximum number of records to return. Defaults to return all records.
+        offset      -- The number of records to skip.
+        batch_size  -- The number of rows to fetch from the database at a time.
+        use_numpy   -- Return NumPy arrays if NumPy is installed (otherwise array.arrays & lists).
+        RETURN >>> >>> A dictionary of {key: column of values} for the requested columns, in row order.
+        """
+        query = self._select_query(table_name, select_dict, get_list, sort_by, limit is not None, offset is not None)
+        schema = self._schema[table_name]
+        # rowid is the only column that isn't in the table schema
+        columns = []
+        for key in query.get_list:
+            typecode = schema.typecodes.get(key.lower(), "q")
+            columns.append(array.array(typecode) if typecode else [])
+
+        with self._reader() as c:
+            params = self._select_params(select_dict, limit, offset)
+            start = time.perf_counter()
+            c.execute(query.sql, params)
+            count = 0
+            while True:
+                rows = c.fetchmany(batch_size)
+                if not rows:
+                    break
+                count += len(rows)
+                # transpose the batch into a tuple of values per column
+                for i, values in enumerate(zip(*rows)):
+                    column = columns[i]
+                    if isinstance(column, list):
+                        column.extend(values)
+                        continue
+                    # fromlist leaves the array unchanged if any value doesn't fit
+                    try:
+                        column.fromlist(list(values))
+                    except (TypeError, OverflowError):
+                        columns[i] = _extend_column(column, values)
+            if self.hook is not None:
+                self._report(c, query.sql, params, len(params), count, start)
+
+        if use_numpy and _numpy is not None:
+            for i, column in enumerate(columns):
+                if isinstance(column, list):
+                    # fill an empty array so that sequence values (e.g. blobs) aren't turned into extra dimensions
+                    columns[i] = _numpy.empty(len(column), dtype=object)
+                    columns[i][:] = column
+                elif column:
+                    # shares the array's memory rather than copying it
+                    columns[i] = _numpy.frombuffer(column, dtype=column.typecode)
                 else:
-                    sort_by[i] = (k, ASC)
-                    self._assert_key_in_table(table_name, k)
+                    columns[i] = _numpy.empty(0, dtype=column.typecode)
+        return dict(zip(query.get_list, columns))
 
-        # make a list of things to match, and their match type (>, =, etc.)
-        params = []
-        select = []
-        for k in select_dict:
-            v, c = select_dict[k] # (value, comparison_type)
-            select.append("{} {} ?".format(k, c))
-            params.append(v)
+    def count(self, table_name, select_dict):
+        """Count the records that match all key:values in the selection dictionary, without fetching them.
 
-        # make strings to send to SQL
-        get    = ", ".join(get_list)
-        select = " AND ".join(select)
-        sort   = " ORDER BY " + ", ".join(" ".join(x) for x in sort_by) if sort_by else ""
-        if _DEBUG: print("@SQL SELECT {} FROM {} WHERE {}{}".format(get, table_name, select, sort), params)
-        self.c.execute("SELECT {} FROM {} WHERE {}{}".format(get, table_name, select, sort), params)
-        results = self.c.fetchall()
-
-        # make a list of dictionaries containing the requested results
-        get_list_of_dicts = []
-        for result in results:
-            # results are {key:value} pairs in a dictionary
-            get_list_of_dicts.append(dict(zip(get_list, result)))
-        return get_list_of_dicts
-
-    def get(self, table_name, select_dict, get_list=None, sort_by=None):
-        """Get the first record that match all key:values in the selection dictionary.
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        RETURN >>> >>> The number of matches
+        """
+        return self.aggregate(table_name, select_dict, {"count": (COUNT, "*")})["count"]
+
+    def aggregate(self, table_name, select_dict, aggregates, group_by=None, sort_by=None):
+        """Calculate COUNT, SUM, AVG, MIN or MAX of columns over the matching records, without fetching them.
+
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        aggregates  -- A dictionary of alias:(AGGREGATE_TYPE, key) to calculate. COUNT can use "*" to count rows.
+                       e.g. {"books":(COUNT, "*"), "total_pages":(SUM, "pages")}
+        group_by    -- A key or list of keys to calculate the aggregates for each value of.
+                       Defaults to calculate them over all matches.
+        sort_by     -- A list of tuples to order the groups by, using group_by keys or aliases.
+                       e.g. [("total_pages",DESCENDING)]
+        RETURN >>> >>> A dictionary of {alias: result}, or with group_by, a list of dictionaries of the group_by
+                       keys and aliases (one per group)
+        """
+        with self._reader() as c:
+            query = self._aggregate_query(table_name, select_dict, aggregates, group_by, sort_by)
+            params = self._select_params(select_dict)
+            results = [dict(zip(query.get_list, result)) for result in self._fetch_all(c, query.sql, params)]
+        return results if group_by else results[0]
+
+    def explain(self, table_name, select_dict, sort_by=None):
+        """Get the query plan SQLite uses for a get_all query, to check that it uses an index.
 
         table_name  -- The table name to search for matches in.
         select_dict -- A dictionary of key:(value, comparison) to match. All must match.
                        e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
-        get_list    -- A list of columns to return. Defaults to return all columns.
         sort_by     -- A list of tuples to order the results by.
                        e.g. [("author",DESCENDING), ("pages":ASCENDING)]
-        RETURN >>> >>> A dictionaries containing the requested columns or None if there is no match.
+        RETURN >>> >>> A dictionary of "sql" (the query), "plan" (a list of the steps from EXPLAIN QUERY PLAN) and
+                       "full_scans" (a list of the tables that are read without an index).
         """
-        # get a list of all results first
-        result = self.get_all(table_name, select_dict, get_list, sort_by)
-        # return the first result if there is one
-        return result[0] if result else None
+        with self._reader() as c:
+            query = self._select_query(table_name, select_dict, None, sort_by)
+            params = self._select_params(select_dict)
+
+            # each row is (id, parent_id, not_used, detail), e.g. "SCAN books" or "SEARCH books USING INDEX ..."
+            # SEARCH only reads the matching rows, SCAN reads every row (even when it's walking an index for ORDER BY)
+            plan = [row[-1] for row in self._fetch_all(c, "EXPLAIN QUERY PLAN " + query.sql, params)]
+            full_scans = []
+            for detail in plan:
+                match = re.match(r"SCAN (?:TABLE )?(\w+)", detail)
+                # reading a long IN list (json_each) isn't a table scan
+                if match and match.group(1) != "CONSTANT" and not "VIRTUAL TABLE" in detail:
+                    full_scans.append(match.group(1))
+            return {"sql": query.sql, "plan": plan, "full_scans": full_scans}
 
     def put(self, table_name, select_dict, put_dict, force_new_record=False):
         """Update if exists or create a record.
@@ -309,47 +2009,43 @@ class Database:
         table_name  -- The table name to search for matches in.
         select_dict -- A dictionary of key:(value, comparison) to match. All must match.
                        e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+                       An empty dictionary always creates a new record (the same as post).
         put_dict    -- A dictionary of data to upsert into the database.
         RETURN >>> >>> The RowID of the edited row (or -1 if no row was changed)
         """
-        # check that table name is valid
-        self._assert_table_in_database_structure(table_name)
-
-        # make sure everything in the select_dict is valid
-        select_dict = self._process_select_dict(table_name, select_dict)
-
-        # check that all keys in put_dict are valid
-        for key in put_dict:
-            self._assert_key_in_table(table_name, key)
-
-        # add everything in select_dict to put_dict
-        for k, v in select_dict.items():
-            if not k in put_dict:
-                put_dict[k] = v[0]
-
-        # create a list of all the values going in
-        params = []
-        for _, v in put_dict.items():
-            params.append(v)
-
-        if not force_new_record:
-            # check if there is already a record in the database
-            result = self.get(table_name, select_dict, ("rowid",))
-
-            # if there is a record, update it
-            if result:
-                params.append(result["rowid"])
-                put = ", ".join("{} = ?".format(k) for k in put_dict)
-                if _DEBUG: print("@SQL UPDATE {} SET {} WHERE rowid=?".format(table_name, put), params)
-                self.c.execute("UPDATE {} SET {} WHERE rowid=?".format(table_name, put), params)
-                return result["rowid"]
-
-        # create a new record
-        put = ", ".join(put_dict)
-        placeholders = ", ".join(["?"] * len(put_dict))
-        if _DEBUG: print("@SQL INSERT INTO {} ({}) VALUES ({})".format(table_name, put, placeholders), params)
-        self.c.execute("INSERT INTO {} ({}) VALUES ({})".format(table_name, put, placeholders), params)
-        return self.c.lastrowid
+        with self._write_lock:
+            query = self._put_query(table_name, select_dict, tuple(put_dict), force_new_record)
+            self._changed(table_name)
+            select_params = self._select_params(select_dict)
+            params = list(put_dict.values())
+
+            # use a single statement if selecting by a unique key
+            if query.upsert:
+                params += select_params
+                rowid = self._fetch_all(self.c, query.upsert, params)[0][0]
+                self._wrote()
+                return rowid
+
+            # add everything in select_dict that isn't in put_dict
+            params += [select_params[i] for i in query.extra]
+
+            if query.lookup:
+                # check if there is already a record in the database
+                result = self._fetch_all(self.c, query.lookup, select_params)
+                result = result[0] if result else None
+
+                # if there is a record, update it
+                if result:
+                    params.append(result[0])
+                    self._execute(self.c, query.update, params)
+                    self._wrote()
+                    return result[0]
+
+            # create a new record
+            self._execute(self.c, query.insert, params)
+            rowid = self.c.lastrowid
+            self._wrote()
+            return rowid
 
     def post(self, table_name, post_dict):
         """Create a new record.
@@ -367,29 +2063,245 @@ class Database:
         table_name  -- The table name to search for matches in.
         select_dict -- A dictionary of key:(value, comparison) to match. All must match.
                        e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+                       It can't be empty, use reset_table to delete every record.
         RETURN >>> >>> The number of rows deleted
         """
+        with self._write_lock:
+            sql = self._delete_query(table_name, select_dict)
+            self._changed(table_name)
+            params = self._select_params(select_dict)
+            self._execute(self.c, sql, params)
+            count = self.c.rowcount
+            self._wrote()
+
+            # return number of rows deleted
+            return count
+
+    def put_many(self, table_name, rows):
+        """Update if exists or create many records in a single transaction.
+
+        table_name  -- The table name to search for matches in.
+        rows        -- An iterable of (select_dict, put_dict) tuples, each one is the same as a put() call.
+                       e.g. [({"author":"Bob"}, {"pages":100}), ({"author":"Jim"}, {"pages":50})]
+        RETURN >>> >>> The number of rows updated or created
+        """
         # check that table name is valid
         self._assert_table_in_database_structure(table_name)
 
-        # make sure everything in the select_dict is valid
-        select_dict = self._process_select_dict(table_name, select_dict)
+        count = 0
+        with self._write_lock, self._atomic():
+            self._changed(table_name)
+            # consecutive rows with the same columns & comparisons share the same SQL, so only check them once
+            for (shape, put_keys), run in groupby(rows, lambda row: (self._select_shape(row[0]), tuple(row[1]))):
+                first = next(run)
+                query = self._put_query(table_name, first[0], put_keys, False)
+                extra = query.extra
+
+                # use a single statement if selecting by a unique key
+                if query.upsert_many:
+                    self._executemany(self.c, query.upsert_many, ([put_dict[k] for k in put_keys] + self._select_params(select_dict)
+                                                           for select_dict, put_dict in chain([first], run)))
+                    count += self.c.rowcount
+                    continue
+
+                # an empty selection dictionary always creates a new record, see put()
+                if query.lookup is None:
+                    self._executemany(self.c, query.insert, ([put_dict[k] for k in put_keys] for _, put_dict in chain([first], run)))
+                    count += self.c.rowcount
+                    continue
+
+                # writes can be held back while they can't change the result of a later lookup. This is true when
+                # every comparison is an equality and no selected column is overwritten, unless a later row
+                # selects values that SQLite could see as equal to a row waiting to be inserted (see _loose_key)
+                batchable = all(c in (EQUAL, "IS") for _, c in shape) and len(extra) == len(shape)
+                updates, inserts, pending = [], [], set()
+
+                def flush():
+                    if updates: self._executemany(self.c, query.update, updates)
+                    if inserts: self._executemany(self.c, query.insert, inserts)
+                    del updates[:], inserts[:]
+                    pending.clear()
+
+                for select_dict, put_dict in chain([first], run):
+                    select_params = self._select_params(select_dict)
+                    signature = tuple(map(_loose_key, select_params))
+                    # a value of a type _loose_key doesn't know could be equal to anything, including later rows
+                    if None in signature:
+                        signature = None
+                    if (not batchable or signature is None or signature in pending or None in pending or
+                            len(updates) + len(inserts) >= _BULK_CHUNK_SIZE):
+                        flush()
+
+                    result = self._fetch_all(self.c, query.lookup, select_params)
+                    result = result[0] if result else None
+                    params = [put_dict[k] for k in put_keys] + [select_params[i] for i in extra]
+                    if result:
+                        params.append(result[0])
+                        updates.append(params)
+                    else:
+                        inserts.append(params)
+                        pending.add(signature)
+                    count += 1
+                flush()
+        self._wrote(count)
+        return count
+
+    def post_many(self, table_name, rows):
+        """Create many new records in a single transaction.
+
+        table_name  -- The table name to insert into.
+        rows        -- An iterable of dictionaries of data to insert into the database, see post().
+        RETURN >>> >>> The number of rows created
+        """
+        # check that table name is valid
+        self._assert_table_in_database_structure(table_name)
 
-        # make a list of things to match, and their match type (>, =, etc.)
-        params = []
-        select = []
-        for k in select_dict:
-            v, c = select_dict[k] # (value, comparison_type)
-            select.append("{} {} ?".format(k, c))
-            params.append(v)
+        count = 0
+        with self._write_lock, self._atomic():
+            self._changed(table_name)
+            # consecutive rows with the same keys share the same SQL, so only check them once
+            for keys, run in groupby(rows, tuple):
+                # same as a put request, but force a new record
+                query = self._put_query(table_name, {}, keys, True)
 
-        # make strings to send to SQL
-        select = " AND ".join(select)
-        if _DEBUG: print("@SQL DELETE FROM {} WHERE {}".format(table_name, select), params)
-        self.c.execute("DELETE FROM {} WHERE {}".format(table_name, select), params)
+                # itemgetter returns a single value (rather than a tuple) when there is one key
+                getter = itemgetter(*keys) if len(keys) > 1 else lambda row: tuple(row[k] for k in keys)
+                self._executemany(self.c, query.insert, map(getter, run))
+                count += self.c.rowcount
+        self._wrote(count)
+        return count
+
+    def delete_many(self, table_name, selects):
+        """Delete all records that match any of the selection dictionaries, in a single transaction.
 
-        # return number of rows deleted
-        return self.c.rowcount
+        table_name  -- The table name to search for matches in.
+        selects     -- An iterable of selection dictionaries, each one is the same as a delete() call.
+                       None of them can be empty, nothing is deleted if one is.
+        RETURN >>> >>> The number of rows deleted
+        """
+        # check that table name is valid
+        self._assert_table_in_database_structure(table_name)
+
+        count = 0
+        with self._write_lock, self._atomic():
+            self._changed(table_name)
+            # consecutive selection dictionaries with the same shape share the same SQL, so only check them once
+            for shape, run in groupby(selects, self._select_shape):
+                first = next(run)
+                sql = self._delete_query(table_name, first)
+                self._executemany(self.c, sql, map(self._select_params, chain([first], run)))
+                count += self.c.rowcount
+        self._wrote(count)
+        return count
+
+    def import_rows(self, table_name, source, file_format=CSV, chunk_size=_BULK_CHUNK_SIZE, defer_indexes=None,
+                    progress=None):
+        """Insert every row from a CSV or JSON lines file, in a single transaction.
+
+        The columns are checked once, from the CSV header or the first JSON object's keys (every later object
+        must have the same keys). Rows are inserted chunk_size at a time with executemany.
+        Empty CSV values are inserted as NULL, and other values are converted by the column's type affinity.
+        table_name    -- The table name to insert into.
+        source        -- A filename, or a file object or iterator of lines.
+        file_format   -- CSV or JSONL.
+        chunk_size    -- The number of rows to send to SQLite at a time.
+        defer_indexes -- Drop the table's INDEXes (from the database structure) before inserting and create them
+                         again afterwards, which is much faster than updating them for every row. Defaults to
+                         only when the table is empty. If a UNIQUE INDEX can't be created again the import fails.
+        progress      -- A function called after each chunk with (rows_so_far, rows_per_second).
+        RETURN >>> >>> The number of rows inserted
+        """
+        self._assert_table_in_database_structure(table_name)
+        self._assert_valid_file_format(file_format)
+        schema = self._schema[table_name]
+
+        count = 0
+        start = time.time()
+        with _open_file(source, "r") as f, self._write_lock, self._atomic():
+            self._changed(table_name)
+            if file_format == CSV:
+                rows = csv.reader(f)
+                keys = next(rows, None)
+                rows = ([None if v == "" else v for v in row] for row in rows)
+            else:
+                rows = (json.loads(line) for line in f if line.strip())
+                first = next(rows, None)
+                keys = list(first) if first is not None else None
+                rows = _json_values(chain([first], rows), keys)
+            if not keys:
+                return 0
+
+            # check the columns once for the whole file
+            if len(set(k.lower() for k in keys)) != len(keys):
+                raise SyntaxError("Duplicate columns in the {} header.".format(file_format))
+            sql = self._put_query(table_name, {}, tuple(keys), True).insert
+
+            if defer_indexes is None:
+                defer_indexes = not self._fetch_all(self.c, "SELECT 1 FROM {} LIMIT 1".format(table_name))
+            if defer_indexes:
+                for name, _ in schema.indexes:
+                    self._execute(self.c, "DROP INDEX IF EXISTS {}".format(name))
+
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                self._executemany(self.c, sql, chunk)
+                count += len(chunk)
+                if progress:
+                    progress(count, count / max(time.time() - start, 1e-9))
+
+            if defer_indexes:
+                for _, index_sql in schema.indexes:
+                    self._execute(self.c, index_sql)
+        self._wrote(count)
+        return count
+
+    def export_rows(self, table_name, select_dict, dest, file_format=CSV, get_list=None, sort_by=None, batch_size=10000,
+                    progress=None):
+        """Write all records that match all key:values in the selection dictionary to a CSV or JSON lines file.
+
+        Rows are streamed from the database batch_size at a time, so the matches are never all in memory.
+        CSV files have a header of the column names, and NULLs are written as empty values.
+        table_name  -- The table name to search for matches in.
+        select_dict -- A dictionary of key:(value, comparison) to match. All must match.
+                       e.g {"author":("Bob", EQUAL), "pages":(100, GREATERTHAN)}
+        dest        -- A filename, or a file object to write to.
+        file_format -- CSV or JSONL.
+        get_list    -- A list of columns to write. Defaults to write all columns.
+        sort_by     -- A list of tuples to order the results by.
+                       e.g. [("author",DESCENDING), ("pages":ASCENDING)]
+        batch_size  -- The number of rows to fetch from the database (and write) at a time.
+        progress    -- A function called after each batch with (rows_so_far, rows_per_second).
+        RETURN >>> >>> The number of rows written
+        """
+        self._assert_valid_file_format(file_format)
+        keys = self._select_query(table_name, select_dict, get_list, sort_by).get_list
+
+        count = 0
+        start = time.time()
+        with _open_file(dest, "w") as f:
+            if file_format == CSV:
+                writer = csv.writer(f)
+                writer.writerow(keys)
+                write = writer.writerows
+            else:
+                # values JSON doesn't have (e.g. dates) are written as strings
+                write = lambda batch: f.writelines(json.dumps(dict(zip(keys, row)), default=str) + "\n" for row in batch)
+            # only query once the file is open, so a file that can't be written doesn't hold a reader
+            rows = self.iter_all(table_name, select_dict, get_list, sort_by, batch_size=batch_size, row_type=TUPLE)
+            try:
+                while True:
+                    batch = list(islice(rows, batch_size))
+                    if not batch:
+                        break
+                    write(batch)
+                    count += len(batch)
+                    if progress:
+                        progress(count, count / max(time.time() - start, 1e-9))
+            finally:
+                rows.close()
+        return count
 
     # alias functions
     upsert = put
@@ -401,9 +2313,6 @@ def test():
     from datetime import datetime
     import os
 
-    global _DEBUG
-    _DEBUG = True
-
     # map of every table and column in database
     # each table is a list of tuples to preserve key order
     database_structure = {
@@ -423,7 +2332,7 @@ def test():
     }
 
     # open database
-    db = Database("test.db", database_structure)
+    db = Database("test.db", database_structure, hook=print_query)
     db.create_table("testTable1")    # create table if it doesn't already exist
     db.create_table("test_table_2")  # create table if it doesn't already exist
     db.reset_table("testTable1")     # deletes everything in table
@@ -460,6 +2369,14 @@ def test():
         # get all columns by default
     ))
 
+    # demo get rows that match any of a list of selection dictionaries
+    print("Get matches for either selection:")
+    pprint(db.get_all(
+        "testTable1",
+        {OR: [{"w": (["I'm Unique", "Other"], IN)}, {"y": ((10, 20), BETWEEN)}]},
+        ["w", "y"]
+    ))
+
     # demo get first row that matches
     print("Get first match:")
     pprint(db.get(
@@ -469,6 +2386,11 @@ def test():
         sort_by=[("y", ASC), ("x", DESC)]
     ))
 
+    # demo get compact rows, read by column name
+    print("Get matches as rows:")
+    for row in db.get_all("testTable1", {"y": 99}, ["w", "y"], row_type=ROW):
+        print(row.w, row["y"])
+
     # demo delete all rows that match
     print("Delete matches...",)
     rows_deleted = db.delete(
@@ -477,6 +2399,16 @@ def test():
     )
     print("deleted {} rows.".format(rows_deleted))
 
+    # demo transaction, everything in the block is undone by the exception
+    print("Transaction rolled back...")
+    try:
+        with db.transaction():
+            db.post("testTable1", {"w": "Temporary", "y": 1})
+            raise ValueError("undo")
+    except ValueError:
+        pass
+    print("rows found:", len(db.get_all("testTable1", {"w": "Temporary"})))
+
     # save and close database
     db.commit()
     db.close()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+##############################################################################
+##                                                                          ##
+##  Module: sqlite3_wrapper_async.py                                        ##
+##                                                                          ##
+##  Description: An asyncio front-end for sqlite3_wrapper. Every Database   ##
+##                 function is awaitable and runs on a dedicated thread so  ##
+##                 the event loop never blocks. Writes are queued and       ##
+##                 committed in groups.                                     ##
+##                                                                          ##
+##        Usage: (See test() for examples.)                                 ##
+##             > import sqlite3_wrapper_async as sql_async                  ##
+##             > db = sql_async.AsyncDatabase("name.db", structure)         ##
+##             > await db.put(table, selection_dictionary, dictionary)      ##
+##                  returns once the write has been committed               ##
+##             > await db.get_all(table, selection_dict)                    ##
+##             > async for row in db.iter_all(table, selection_dict)        ##
+##             > await db.close()                                           ##
+##                                                                          ##
+##############################################################################
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import sqlite3_wrapper as sql
+
+
+class _AsyncRows(object):
+    """An async iterator over a Database.iter_all generator, fetching each batch on an executor thread."""
+    def __init__(self, executor, start, batch_size):
+        self._executor = executor
+        self._start = start
+        self._batch_size = batch_size
+        self._rows = None
+        self._buffer = []
+        self._done = False
+
+    def _fetch(self):
+        """Return the next batch of rows (runs on the executor thread)."""
+        if self._rows is None:
+            self._rows = self._start()
+        return list(islice(self._rows, self._batch_size))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self._buffer:
+            if self._done:
+                raise StopAsyncIteration
+            self._buffer = await asyncio.get_event_loop().run_in_executor(self._executor, self._fetch)
+            # a short batch means the generator is finished
+            if len(self._buffer) < self._batch_size:
+                self._done = True
+            if not self._buffer:
+                raise StopAsyncIteration
+            self._buffer.reverse()
+        return self._buffer.pop()
+
+    async def aclose(self):
+        """Stop iterating early, giving the cursor (and pooled connection) back."""
+        self._done = True
+        self._buffer = []
+        if self._rows is not None:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._rows.close)
+
+
+class AsyncDatabase(object):
+    def __init__(self, fname, database_structure, pool_size=0, max_group_size=1000, **kwargs):
+        """Open database from filename, initialise database structure. See sqlite3_wrapper.Database.
+
+        The database is opened on a dedicated writer thread. With a connection pool (pool_size > 0) reads run
+        on pool_size reader threads, one per reader connection, otherwise they run on the writer thread.
+
+        Writes (put, post, delete, the bulk functions and the table functions) are queued, and every write
+        queued while the previous group was being committed is run in a single transaction with one commit.
+        Each write has its own savepoint, so a write that fails doesn't undo the rest of its group.
+        Awaiting a write returns its result once it has been committed.
+
+        pool_size      -- The number of reader connections & threads (0 to read on the writer thread).
+        max_group_size -- The maximum number of writes committed together.
+        kwargs         -- Passed to Database, e.g. query_cache_size & busy_timeout.
+        """
+        self.max_group_size = max_group_size
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._readers = ThreadPoolExecutor(max_workers=pool_size) if pool_size else self._writer
+
+        # the executor runs jobs in order, so the database is always open before any other job runs
+        self._database = self._writer.submit(sql.Database, fname, database_structure, pool_size=pool_size, **kwargs)
+
+        self._pending = []
+        self._committing = False
+        self._idle = None
+
+    @property
+    def database(self):
+        """The underlying Database. Only use it from the writer thread (or a reader thread for reads)."""
+        return self._database.result()
+
+    async def _read(self, method, *args):
+        """Run a Database read function on a reader thread."""
+        return await asyncio.get_event_loop().run_in_executor(self._readers, lambda: method(self.database, *args))
+
+    def _write(self, method, *args):
+        """Queue a Database write function, returning a future for its result."""
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((method, args, future))
+        if not self._committing:
+            self._committing = True
+            asyncio.ensure_future(self._commit_groups())
+        return future
+
+    def _run_group(self, group):
+        """Run a group of writes in one transaction and commit it (runs on the writer thread).
+
+        RETURN >>> >>> A list of (succeeded, result_or_exception) tuples
+        """
+        db = self.database
+        results = []
+        try:
+            with db.transaction():
+                for method, args, _ in group:
+                    try:
+                        with db.transaction():
+                            results.append((True, method(db, *args)))
+                    except Exception as e:
+                        results.append((False, e))
+        except Exception as e:
+            results = [(False, e)] * len(group)
+        return results
+
+    async def _commit_groups(self):
+        """Commit the queued writes in groups until the queue is empty."""
+        loop = asyncio.get_event_loop()
+        try:
+            while self._pending:
+                group = self._pending[:self.max_group_size]
+                del self._pending[:self.max_group_size]
+                results = await loop.run_in_executor(self._writer, self._run_group, group)
+                for (_, _, future), (succeeded, result) in zip(group, results):
+                    if future.cancelled():
+                        continue
+                    if succeeded:
+                        future.set_result(result)
+                    else:
+                        future.set_exception(result)
+        finally:
+            self._committing = False
+            if self._idle is not None:
+                self._idle.set()
+
+    async def commit(self):
+        """Wait until every queued write has been committed."""
+        while self._committing:
+            self._idle = self._idle or asyncio.Event()
+            self._idle.clear()
+            await self._idle.wait()
+
+    async def close(self):
+        """Commit the queued writes, then close the database and its threads."""
+        await self.commit()
+        await asyncio.get_event_loop().run_in_executor(self._writer, lambda: self.database.close())
+        self._writer.shutdown()
+        if self._readers is not self._writer:
+            self._readers.shutdown()
+
+    def cache_table(self, table_name, maxsize=1000, ttl=None, max_bytes=64 * 1024 * 1024):
+        """See Database.cache_table. Cached results are shared by the reader threads."""
+        self.database.cache_table(table_name, maxsize, ttl, max_bytes)
+
+    def result_cache_info(self, table_name):
+        """See Database.result_cache_info."""
+        return self.database.result_cache_info(table_name)
+
+    # reads
+    async def get_all(self, table_name, select_dict, get_list=None, sort_by=None, limit=None, offset=None,
+                      row_type=sql.DICT):
+        """See Database.get_all."""
+        return await self._read(sql.Database.get_all, table_name, select_dict, get_list, sort_by, limit, offset,
+                                row_type)
+
+    async def get(self, table_name, select_dict, get_list=None, sort_by=None, row_type=sql.DICT):
+        """See Database.get."""
+        return await self._read(sql.Database.get, table_name, select_dict, get_list, sort_by, row_type)
+
+    async def get_page(self, table_name, select_dict, get_list=None, sort_by=None, page_size=100, token=None):
+        """See Database.get_page."""
+        return await self._read(sql.Database.get_page, table_name, select_dict, get_list, sort_by, page_size, token)
+
+    def iter_all(self, table_name, select_dict, get_list=None, sort_by=None, limit=None, offset=None, batch_size=1000, row_type=sql.DICT):
+        """See Database.iter_all. Returns an async iterator, use with "async for"."""
+        start = lambda: self.database.iter_all(table_name, select_dict, get_list, sort_by, limit, offset, batch_size, row_type)
+        return _AsyncRows(self._readers, start, batch_size)
+
+    async def get_columns(self, table_name, select_dict, get_list=None, sort_by=None, limit=None, offset=None,
+                          batch_size=10000, use_numpy=True):
+        """See Database.get_columns."""
+        return await self._read(sql.Database.get_columns, table_name, select_dict, get_list, sort_by, limit, offset,
+                                batch_size, use_numpy)
+
+    async def count(self, table_name, select_dict):
+        """See Database.count."""
+        return await self._read(sql.Database.count, table_name, select_dict)
+
+    async def aggregate(self, table_name, select_dict, aggregates, group_by=None, sort_by=None):
+        """See Database.aggregate."""
+        return await self._read(sql.Database.aggregate, table_name, select_dict, aggregates, group_by, sort_by)
+
+    async def export_rows(self, table_name, select_dict, dest, file_format=sql.CSV, get_list=None, sort_by=None,
+                          batch_size=10000, progress=None):
+        """See Database.export_rows. progress is called on the reader thread."""
+        return await self._read(sql.Database.export_rows, table_name, select_dict, dest, file_format, get_list, sort_by,
+                                batch_size, progress)
+
+    async def table_exists(self, table_name):
+        """See Database.table_exists."""
+        return await self._read(sql.Database.table_exists, table_name)
+
+    async def explain(self, table_name, select_dict, sort_by=None):
+        """See Database.explain."""
+        return await self._read(sql.Database.explain, table_name, select_dict, sort_by)
+
+    # writes
+    async def put(self, table_name, select_dict, put_dict, force_new_record=False):
+        """See Database.put."""
+        return await self._write(sql.Database.put, table_name, select_dict, put_dict, force_new_record)
+
+    async def post(self, table_name, post_dict):
+        """See Database.post."""
+        return await self._write(sql.Database.post, table_name, post_dict)
+
+    async def delete(self, table_name, select_dict):
+        """See Database.delete."""
+        return await self._write(sql.Database.delete, table_name, select_dict)
+
+    async def put_many(self, table_name, rows):
+        """See Database.put_many."""
+        return await self._write(sql.Database.put_many, table_name, rows)
+
+    async def post_many(self, table_name, rows):
+        """See Database.post_many."""
+        return await self._write(sql.Database.post_many, table_name, rows)
+
+    async def delete_many(self, table_name, selects):
+        """See Database.delete_many."""
+        return await self._write(sql.Database.delete_many, table_name, selects)
+
+    async def import_rows(self, table_name, source, file_format=sql.CSV, chunk_size=10000, defer_indexes=None,
+                          progress=None):
+        """See Database.import_rows. progress is called on the writer thread."""
+        return await self._write(sql.Database.import_rows, table_name, source, file_format, chunk_size, defer_indexes,
+                                 progress)
+
+    async def create_table(self, table_name):
+        """See Database.create_table."""
+        return await self._write(sql.Database.create_table, table_name)
+
+    async def create_all_tables(self):
+        """See Database.create_all_tables."""
+        return await self._write(sql.Database.create_all_tables)
+
+    async def delete_table(self, table_name):
+        """See Database.delete_table."""
+        return await self._write(sql.Database.delete_table, table_name)
+
+    async def delete_all_tables(self):
+        """See Database.delete_all_tables."""
+        return await self._write(sql.Database.delete_all_tables)
+
+    async def reset_table(self, table_name):
+        """See Database.reset_table."""
+        return await self._write(sql.Database.reset_table, table_name)
+
+    async def reset_all_tables(self):
+        """See Database.reset_all_tables."""
+        return await self._write(sql.Database.reset_all_tables)
+
+    # alias functions
+    upsert = put
+    insert = post
+
+
+def test():
+    from pprint import pprint
+    import os
+
+    database_structure = {
+        "books": [
+            ("name",   "TEXT PRIMARY KEY"),
+            ("author", "TEXT"),
+            ("pages",  "INTEGER"),
+        ],
+    }
+
+    async def demo():
+        # open database with two reader threads
+        db = AsyncDatabase("test_async.db", database_structure, pool_size=2)
+        await db.create_all_tables()
+        await db.reset_table("books")
+
+        # these writes are queued together and committed as a group
+        print("Insert into table...")
+        await asyncio.gather(*[
+            db.put("books", {"name": "Book {}".format(i)}, {"author": "Bob", "pages": i * 100})
+            for i in range(10)
+        ])
+
+        # demo get all rows that match
+        print("Get all matches:")
+        pprint(await db.get_all("books", {"pages": (500, sql.GREATERTHAN)}, ["name", "pages"]))
+
+        # demo iterate over rows without loading them all at once
+        print("Iterate over matches:")
+        async for row in db.iter_all("books", {"author": "Bob"}, ["name"], batch_size=4, row_type=sql.TUPLE):
+            print(row)
+
+        # reads inside iter_all loops share the loop's reader, so they never wait for a free one
+        print("Read while iterating:")
+        async for row in db.iter_all("books", {"pages": (700, sql.GREATERTHAN)}, ["name"], batch_size=1):
+            async for same in db.iter_all("books", {"name": row["name"]}, ["pages"], batch_size=1):
+                book = await asyncio.wait_for(db.get("books", {"name": row["name"]}, ["author"]), 3)
+                print(row["name"], same["pages"], book["author"])
+
+        await db.close()
+
+    asyncio.run(demo())
+
+    # delete database
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists("test_async.db" + suffix):
+            os.remove("test_async.db" + suffix)
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+##############################################################################
+##                                                                          ##
+##  Module: sqlite3_wrapper_benchmark.py                                    ##
+##                                                                          ##
+##  Description: Benchmarks for sqlite3_wrapper. Compares the bulk          ##
+##                 functions with the equivalent per-row loops, read        ##
+##                 throughput for different connection pool sizes and mmap  ##
+##                 sizes, and times every Database function on synthetic    ##
+##                 tables.                                                  ##
+##                                                                          ##
+##        Usage: > python3 sqlite3_wrapper_benchmark.py [--rows N]          ##
+##             > python3 sqlite3_wrapper_benchmark.py --concurrency         ##
+##             > python3 sqlite3_wrapper_benchmark.py --mmap --rows N       ##
+##             > python3 sqlite3_wrapper_benchmark.py --suite --rows N      ##
+##                  [--columns int=2,real=1,text=2] [--json out.json]       ##
+##                  [--compare previous.json]                               ##
+##                                                                          ##
+##############################################################################
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlite3_wrapper as sql
+
+DATABASE_STRUCTURE = {
+    "books": [
+        ("name",   "TEXT"),
+        ("author", "TEXT"),
+        ("pages",  "INTEGER"),
+        ("rating", "REAL"),
+        ("INDEX books_by_name", "(name)"),
+    ],
+}
+
+
+def make_rows(count):
+    """Return a list of synthetic rows for the "books" table."""
+    return [{"name": "book {}".format(i), "author": "author {}".format(i % 100), "pages": i % 1000, "rating": i % 5 / 2.0}
+            for i in range(count)]
+
+
+def timed(fn, *args):
+    """Run fn(*args) and return how long it took in seconds."""
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def fresh_database(fname):
+    """Return a database with an empty "books" table."""
+    db = sql.Database(fname, DATABASE_STRUCTURE)
+    db.delete_all_tables()
+    db.create_all_tables()
+    db.commit()
+    return db
+
+
+def bench_bulk(fname, count):
+    """Time post/put/delete in a per-row loop against post_many/put_many/delete_many.
+
+    RETURN >>> >>> A list of (name, seconds_for_loop, seconds_for_bulk) tuples
+    """
+    rows = make_rows(count)
+    updates = [({"name": row["name"]}, {"pages": row["pages"] + 1}) for row in rows]
+    selects = [{"name": row["name"]} for row in rows]
+
+    def loop_post(db):
+        for row in rows:
+            db.post("books", row)
+
+    def loop_put(db):
+        for select_dict, put_dict in updates:
+            db.put("books", select_dict, dict(put_dict))
+
+    def loop_delete(db):
+        for select_dict in selects:
+            db.delete("books", select_dict)
+
+    results = []
+    for name, loop, bulk in [
+        ("post",   loop_post,   lambda db: db.post_many("books", rows)),
+        ("put",    loop_put,    lambda db: db.put_many("books", updates)),
+        ("delete", loop_delete, lambda db: db.delete_many("books", selects)),
+    ]:
+        timings = []
+        for fn in (loop, bulk):
+            db = fresh_database(fname)
+            # put and delete need existing rows to work on
+            if name != "post":
+                db.post_many("books", rows)
+                db.commit()
+            timings.append(timed(lambda: (fn(db), db.commit())))
+            db.close()
+        results.append((name, timings[0], timings[1]))
+    return results
+
+
+def bench_concurrent_reads(fname, count, pool_sizes, threads, reads):
+    """Time get() calls spread over threads, for each connection pool size.
+
+    RETURN >>> >>> A list of (pool_size, reads_per_second) tuples
+    """
+    db = fresh_database(fname)
+    db.post_many("books", make_rows(count))
+    db.commit()
+    db.close()
+
+    def read(db, n):
+        names = ["book {}".format(random.randrange(count)) for _ in range(n)]
+        for name in names:
+            db.get("books", {"name": name})
+
+    results = []
+    for pool_size in pool_sizes:
+        db = sql.Database(fname, DATABASE_STRUCTURE, pool_size=pool_size)
+        with ThreadPoolExecutor(threads) as executor:
+            start = time.perf_counter()
+            list(executor.map(read, [db] * threads, [reads // threads] * threads))
+            seconds = time.perf_counter() - start
+        db.close()
+        results.append((pool_size, reads / seconds))
+    return results
+
+
+def bench_mmap(fname, count, mmap_sizes, scans):
+    """Time get_all scans of the whole table, for each mmap_size (see sqlite3_wrapper.PROFILES).
+
+    count() scans are timed too, they show the I/O without the cost of making a dictionary for each row.
+    RETURN >>> >>> A list of (mmap_size, effective_mmap_size, get_all_rows_per_second, count_rows_per_second) tuples
+    """
+    db = fresh_database(fname)
+    db.post_many("books", make_rows(count))
+    db.commit()
+    db.close()
+
+    results = []
+    for mmap_size in mmap_sizes:
+        db = sql.Database(fname, DATABASE_STRUCTURE, profile={"mmap_size": mmap_size})
+        # warm up the OS page cache, so every size reads the same cached file
+        db.get_all("books", {})
+        seconds = timed(lambda: [db.get_all("books", {"pages": (0, sql.GTEQ)}) for _ in range(scans)])
+        count_seconds = timed(lambda: [db.count("books", {"rating": (0, sql.GTEQ)}) for _ in range(scans)])
+        results.append((mmap_size, db.settings()["mmap_size"], count * scans / seconds, count * scans / count_seconds))
+        db.close()
+    return results
+
+
+def parse_columns(spec):
+    """Parse a column mix such as "int=2,real=1,text=2".
+
+    RETURN >>> >>> A list of (type, count) tuples
+    """
+    columns = []
+    for part in spec.split(","):
+        kind, _, number = part.partition("=")
+        if not kind in SUITE_TYPES:
+            raise ValueError("Unknown column type '{}', use one of: {}".format(kind, ", ".join(sorted(SUITE_TYPES))))
+        columns.append((kind, int(number or 1)))
+    return columns
+
+
+# the declared type and a value generator for each column type in a column mix
+SUITE_TYPES = {
+    "int":  ("INTEGER", lambda rng: rng.randrange(1000)),
+    "real": ("REAL",    lambda rng: rng.random() * 1000),
+    "text": ("TEXT",    lambda rng: "text {}".format(rng.randrange(1000000))),
+}
+
+
+def make_structure(columns):
+    """Return a database structure for a "bench" table with a unique key and the column mix.
+
+    The first int column (if there is one) has an index, so there are selective and broad queries to time.
+    """
+    table = [("key", "TEXT PRIMARY KEY")]
+    for kind, number in columns:
+        for i in range(number):
+            table.append(("{}_{}".format(kind, i), SUITE_TYPES[kind][0]))
+    if any(k == "int_0" for k, _ in table):
+        table.append(("INDEX bench_by_int_0", "(int_0)"))
+    return {"bench": table}
+
+
+def make_suite_rows(structure, start, count, rng):
+    """Yield count synthetic rows for the "bench" table, with keys from start."""
+    generators = [(k, SUITE_TYPES[k.split("_")[0]][1]) for k, _ in structure["bench"][1:] if not k.startswith("INDEX")]
+    for i in range(start, start + count):
+        row = {"key": "key {:09d}".format(i)}
+        for k, generate in generators:
+            row[k] = generate(rng)
+        yield row
+
+
+def bench_suite(fname, rows, columns, ops, scan_ops, seed):
+    """Time each Database function on a "bench" table of rows synthetic rows.
+
+    Point operations (post, put, get, delete) run ops times, whole table queries run scan_ops times.
+    RETURN >>> >>> A dictionary of {operation: {"ops", "seconds", "ops_per_sec"}}
+    """
+    rng = random.Random(seed)
+    structure = make_structure(columns)
+    db = sql.Database(fname, structure)
+    db.delete_all_tables()
+    db.create_all_tables()
+    db.commit()
+
+    results = {}
+    def record(name, count, fn):
+        """Time fn() and a commit."""
+        seconds = timed(lambda: (fn(), db.commit()))
+        results[name] = {"ops": count, "seconds": seconds, "ops_per_sec": count / seconds if seconds else None}
+
+    def run(name, fn, args):
+        """Time fn(*arg) for each of args (which are made before timing starts)."""
+        record(name, len(args), lambda: [fn(*arg) for arg in args])
+
+    record("populate (post_many)", rows, lambda: db.post_many("bench", make_suite_rows(structure, 0, rows, rng)))
+
+    existing = ["key {:09d}".format(rng.randrange(rows)) for _ in range(ops)]
+    new_rows = list(make_suite_rows(structure, rows, ops * 2, rng))
+    has_int = any(k == "int_0" for k, _ in structure["bench"])
+    column = structure["bench"][1][0]
+
+    run("post", db.post, [("bench", row) for row in new_rows[:ops]])
+    run("put (insert)", db.put, [("bench", {"key": row["key"]}, {column: row[column]}) for row in new_rows[ops:]])
+    run("put (update)", db.put, [("bench", {"key": key}, {column: row[column]}) for key, row in zip(existing, new_rows)])
+    if has_int:
+        # not a unique key, so put looks the row up and then updates it
+        run("put (update, lookup)", db.put, [("bench", {"int_0": rng.randrange(1000)}, {"int_0": rng.randrange(1000)})
+                                             for _ in range(ops)])
+    run("get", db.get, [("bench", {"key": key}) for key in existing])
+    if has_int:
+        # about rows / 1000 matches each, using the index
+        run("get_all (selective)", db.get_all, [("bench", {"int_0": rng.randrange(1000)}) for _ in range(ops)])
+        broad = {"int_0": (500, sql.GTEQ)}
+    else:
+        broad = {}
+    # about half of the rows
+    run("get_all (broad)", db.get_all, [("bench", broad)] * scan_ops)
+    run("get_all (broad, sorted)", db.get_all, [("bench", broad, None, [(column, sql.DESC)])] * scan_ops)
+    run("delete", db.delete, [("bench", {"key": key}) for key in existing])
+    record("reset_table", 1, lambda: db.reset_table("bench"))
+    db.close()
+    return results
+
+
+def compare_results(previous, current):
+    """Print the change in operations per second of each result since a previous run."""
+    print("{:<10} {:<26} {:>14} {:>14} {:>8}".format("storage", "operation", "before ops/s", "after ops/s", "change"))
+    for storage, results in current["results"].items():
+        for name, result in results.items():
+            before = previous.get("results", {}).get(storage, {}).get(name)
+            if not before or not before["ops_per_sec"] or not result["ops_per_sec"]:
+                continue
+            change = result["ops_per_sec"] / before["ops_per_sec"] - 1
+            print("{:<10} {:<26} {:>14,.0f} {:>14,.0f} {:>+7.1%}".format(
+                storage, name, before["ops_per_sec"], result["ops_per_sec"], change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sqlite3_wrapper.")
+    parser.add_argument("--rows", type=int, default=10000, help="number of rows to write (default: %(default)s)")
+    parser.add_argument("--db", default=":memory:", help="database file to use (default: %(default)s)")
+    parser.add_argument("--concurrency", action="store_true", help="benchmark read throughput against pool size")
+    parser.add_argument("--pool-sizes", default="1,2,4,8", help="pool sizes for --concurrency (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=8, help="reader threads for --concurrency (default: %(default)s)")
+    parser.add_argument("--reads", type=int, default=20000, help="total reads for --concurrency (default: %(default)s)")
+    parser.add_argument("--mmap", action="store_true", help="benchmark get_all scans against mmap_size")
+    parser.add_argument("--mmap-sizes", default="0,268435456,2147483648",
+                        help="mmap sizes in bytes for --mmap (default: %(default)s)")
+    parser.add_argument("--scans", type=int, default=5, help="scans of the table for --mmap (default: %(default)s)")
+    parser.add_argument("--suite", action="store_true", help="time every Database function on a synthetic table")
+    parser.add_argument("--columns", default="int=2,real=1,text=2", help="column mix for --suite (default: %(default)s)")
+    parser.add_argument("--ops", type=int, default=2000, help="operations per point test for --suite (default: %(default)s)")
+    parser.add_argument("--scan-ops", type=int, default=3, help="operations per broad query for --suite (default: %(default)s)")
+    parser.add_argument("--storage", default="memory,disk", help="storage for --suite (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for --suite (default: %(default)s)")
+    parser.add_argument("--json", help="write the --suite results to this JSON file")
+    parser.add_argument("--compare", help="compare the --suite results with a previous JSON file")
+    args = parser.parse_args()
+
+    if args.mmap:
+        # mmap needs a database file
+        fname, directory = args.db, None
+        if fname == ":memory:":
+            directory = tempfile.mkdtemp()
+            fname = os.path.join(directory, "benchmark.db")
+        mmap_sizes = [int(x) for x in args.mmap_sizes.split(",")]
+        print("{:<14} {:>14} {:>16} {:>16}".format("mmap_size", "effective", "get_all rows/s", "count rows/s"))
+        try:
+            for mmap_size, effective, rate, count_rate in bench_mmap(fname, args.rows, mmap_sizes, args.scans):
+                print("{:<14,} {:>14,} {:>16,.0f} {:>16,.0f}".format(mmap_size, effective, rate, count_rate))
+        finally:
+            if directory:
+                shutil.rmtree(directory)
+        return
+
+    if args.suite:
+        columns = parse_columns(args.columns)
+        report = {
+            "meta": {
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "sqlite3_wrapper": sql.__version__,
+                "sqlite": sql.sqlite3.sqlite_version, "python": platform.python_version(), "platform": platform.platform(),
+                "rows": args.rows, "columns": args.columns, "ops": args.ops, "scan_ops": args.scan_ops, "seed": args.seed,
+            },
+            "results": {},
+        }
+        for storage in args.storage.split(","):
+            directory = None
+            if storage == "memory":
+                fname = ":memory:"
+            elif args.db != ":memory:":
+                fname = args.db
+            else:
+                directory = tempfile.mkdtemp()
+                fname = os.path.join(directory, "benchmark.db")
+            try:
+                results = bench_suite(fname, args.rows, columns, args.ops, args.scan_ops, args.seed)
+            finally:
+                if directory:
+                    shutil.rmtree(directory)
+            report["results"][storage] = results
+
+            print("{:<26} {:>10} {:>10} {:>14}".format(storage, "ops", "seconds", "ops/s"))
+            for name, result in results.items():
+                print("{:<26} {:>10,} {:>10.3f} {:>14,.0f}".format(name, result["ops"], result["seconds"], result["ops_per_sec"] or 0))
+            print()
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+        if args.compare:
+            with open(args.compare) as f:
+                compare_results(json.load(f), report)
+        return
+
+    if args.concurrency:
+        # a pool needs a database file
+        fname, directory = args.db, None
+        if fname == ":memory:":
+            directory = tempfile.mkdtemp()
+            fname = os.path.join(directory, "benchmark.db")
+        pool_sizes = [int(x) for x in args.pool_sizes.split(",")]
+        print("{:<10} {:>14}".format("pool size", "reads/s"))
+        try:
+            for pool_size, rate in bench_concurrent_reads(fname, args.rows, pool_sizes, args.threads, args.reads):
+                print("{:<10} {:>14,.0f}".format(pool_size, rate))
+        finally:
+            # the database, -wal & -shm files
+            if directory:
+                shutil.rmtree(directory)
+        return
+
+    print("{:<8} {:>14} {:>14} {:>8}".format("", "loop rows/s", "bulk rows/s", "speedup"))
+    for name, loop, bulk in bench_bulk(args.db, args.rows):
+        print("{:<8} {:>14,.0f} {:>14,.0f} {:>7.1f}x".format(name, args.rows / loop, args.rows / bulk, loop / bulk))
+
+
+if __name__ == "__main__":
+    main()